@@ -8,6 +8,8 @@ from datetime import datetime
 import time
 import os
 import signal
+import mmap
+import metrics
 
 
 class DumbReader(typing.BinaryIO):
@@ -72,11 +74,35 @@ class DumbReader(typing.BinaryIO):
         pass
 
 
+def track_process(proc):
+    # running ffmpeg processes and their runtime for metrics
+    metrics.ffmpeg_processes.inc()
+    started = time.monotonic()
+
+    async def wait():
+        try:
+            await proc.wait()
+        finally:
+            metrics.ffmpeg_processes.dec()
+            metrics.stage_seconds.observe(time.monotonic() - started, stage='ffmpeg_runtime')
+    asyncio.ensure_future(wait())
+    return proc
+
+
 class FFMpegAV(DumbReader):
 
     def __init__(self):
         self._buf = b''
         self.file_name = None
+        self.stream = None
+
+    @staticmethod
+    def from_file(file_name, format):
+        # already remuxed file, e.g. from spool cache
+        ff = FFMpegAV()
+        ff.file_name = file_name
+        ff.format = format
+        return ff
 
     @staticmethod
     async def create(vformat,
@@ -88,6 +114,7 @@ class FFMpegAV(DumbReader):
                      format_name='',
                      file_name=None,
                      restrict_size=True):
+        started = time.monotonic()
         if headers != '':
             headers = "\n".join(av_utils.dict_to_list(headers))
         ff = FFMpegAV()
@@ -95,9 +122,10 @@ class FFMpegAV(DumbReader):
         _finput = None
 
         if file_name:
+            file_dir, file_name = os.path.split(file_name)
             if len(file_name) > 100:
                 file_name = file_name[:50] + file_name[-50:]
-            ff.file_name = "'" + file_name.replace('/', '').replace('\'', '') + "'"
+            ff.file_name = os.path.join(file_dir, "'" + file_name.replace('\'', '') + "'")
 
         cut_time_fix_args = []
         cut_time_start = cut_time_end = None
@@ -218,8 +246,15 @@ class FFMpegAV(DumbReader):
         else:
             proc = await asyncio.create_subprocess_exec('ffmpeg',
                                                         *args[1:])
+        track_process(proc)
+        ff.stream = proc
         if headers != '':
-            await asyncio.sleep(1)
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                # job is cancelled while ffmpeg starts, nobody else has the process to close it
+                ff.safe_close()
+                raise
             if proc.returncode is not None and proc.returncode != 0:
                 return await FFMpegAV.create(vformat,
                                              aformat=aformat,
@@ -229,7 +264,7 @@ class FFMpegAV(DumbReader):
                                              ext=ext,
                                              format_name=format_name,
                                              file_name=file_name)
-        ff.stream = proc
+        metrics.stage_seconds.observe(time.monotonic() - started, stage='ffmpeg_startup')
 
         return ff
 
@@ -260,10 +295,20 @@ class FFMpegAV(DumbReader):
             pass
 
     def safe_close(self):
+        # doesn't wait for ffmpeg exit on the event loop, SIGKILL is sent later if it's still running
+        if self.stream is None:
+            return
         self.close()
-        time.sleep(2)
+        asyncio.get_event_loop().call_later(2, self._kill)
+
+    def _kill(self):
         # sometimes ffmpeg don't want to exit after any signal except SIGKILL
-        os.kill(self.stream.pid, signal.SIGKILL)
+        if self.stream.returncode is not None:
+            return
+        try:
+            os.kill(self.stream.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
 
     def __del__(self):
         try:
@@ -342,6 +387,81 @@ class URLav(DumbReader):
             return b
 
 
+class LocalFileAV(DumbReader):
+    # local file served straight from page cache through mmap,
+    # so reads don't need a thread pool round trip like aiofiles
+    READAHEAD_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._file = open(file_name, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._mmap = None
+        if self.size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(self._mmap, 'madvise'):
+                self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+        self._pos = 0
+        self._readahead_pos = 0
+
+    def _readahead(self, offset, n):
+        # ask kernel to load pages ahead of the reader, madvise doesn't block
+        end = offset + n + self.READAHEAD_SIZE
+        if not hasattr(self._mmap, 'madvise') or self._readahead_pos >= min(end, self.size):
+            return
+        start = max(self._readahead_pos, offset) // mmap.PAGESIZE * mmap.PAGESIZE
+        self._mmap.madvise(mmap.MADV_WILLNEED, start, min(end, self.size) - start)
+        self._readahead_pos = min(end, self.size)
+
+    def read_part(self, offset, n):
+        # random access read, used by parallel uploaders for their own parts,
+        # returns memoryview of the mapping so the part isn't copied until it's serialized
+        if self._mmap is None or offset >= self.size:
+            return memoryview(b'')
+        self._readahead(offset, n)
+        return memoryview(self._mmap)[offset:offset + n]
+
+    async def read(self, n: int = -1):
+        # stream readers like telethon's upload_file expect bytes
+        if n == -1:
+            n = self.size - self._pos
+        data = bytes(self.read_part(self._pos, n))
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._pos = offset
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # parts are still referenced by upload requests,
+                # file is unmapped when the last of them is freed
+                pass
+            self._mmap = None
+        self._file.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        b = await self.read(512 * 1024)
+        if len(b) == 0:
+            raise StopAsyncIteration()
+        else:
+            return b
+
+
 async def video_screenshot(url, headers=None, screen_time=None, quality=5):
     image_data = await _video_screenshot(url, headers, screen_time=screen_time, quality=quality)
     if len(image_data) == 0:
@@ -371,6 +491,7 @@ async def _video_screenshot(url, headers=None, screen_time=None, quality=5):
                                                 *args[1:],
                                                 stdout=asyncio.subprocess.PIPE,
                                                 stderr=asyncio.subprocess.PIPE)
+    track_process(proc)
 
     try:
         out = await asyncio.wait_for(proc.stdout.read(), timeout=360)
@@ -5,6 +5,7 @@ import os, signal
 from aiohttp import ClientSession, hdrs, TCPConnector
 from http.client import responses
 from urllib.parse import urlparse
+import metrics
 
 
 # convert each key-value to string like "key: value"
@@ -16,10 +17,11 @@ def dict_to_list(_dict):
     return ret
 
 async def av_info(url, http_headers=''):
-    info = await _av_info(url, http_headers)
-    if len(info.keys()) == 0:
-        # some sites return error if headers was passed
-        info = await _av_info(url)
+    with metrics.stage_seconds.time(stage='ffprobe'):
+        info = await _av_info(url, http_headers)
+        if len(info.keys()) == 0:
+            # some sites return error if headers was passed
+            info = await _av_info(url)
 
     return info
 
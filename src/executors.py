@@ -0,0 +1,75 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class NamedExecutor:
+    """
+    Thread pool for one class of blocking work,
+    so slow work of one class doesn't delay the others.
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        # seconds tasks waited for free thread
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.busy_time = 0.0
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers, 'queued': self.queued, 'active': self.active,
+                    'completed': self.completed, 'wait_time': round(self.wait_time, 3),
+                    'max_wait': round(self.max_wait, 3), 'busy_time': round(self.busy_time, 3)}
+
+    def _call(self, task, func, args, kwargs):
+        started = time.monotonic()
+        wait = started - task['submitted']
+        with self._lock:
+            task['started'] = True
+            if not task['dropped']:
+                self.queued -= 1
+            self.active += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+                self.busy_time += time.monotonic() - started
+
+    async def run(self, func, *args, **kwargs):
+        task = {'submitted': time.monotonic(), 'started': False, 'dropped': False}
+        with self._lock:
+            self.queued += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.pool, self._call, task, func, args, kwargs)
+        except asyncio.CancelledError:
+            # cancelled task may never get to the thread
+            with self._lock:
+                if not task['started']:
+                    task['dropped'] = True
+                    self.queued -= 1
+            raise
+
+
+# database requests are short and shouldn't wait behind extraction
+db = NamedExecutor('db', int(os.getenv('DB_THREADS', 8)))
+# youtube_dl extraction and format processing
+extraction = NamedExecutor('extraction', int(os.getenv('EXTRACTION_THREADS', 16)))
+# spool file reads and writes, checksums
+file_io = NamedExecutor('file_io', int(os.getenv('FILE_IO_THREADS', 4)))
+
+
+def stats():
+    return {e.name: e.stats() for e in (db, extraction, file_io)}
@@ -0,0 +1,90 @@
+import re
+import time
+from urllib.parse import urlparse
+
+
+# host labels written in _VALID_URL like "tiktok\.com", "pinterest\.(?:com|fr)", "vimeo(?:pro)?\.com"
+host_label_re = re.compile(r'([a-z0-9][a-z0-9-]*)(?:\(\?:[a-z0-9|-]*\)\??)?\\\.(?=[a-z]{2,}|\(\?:)')
+# or alternatives like "(?:youtube|invidio)\.com"
+host_group_re = re.compile(r'\(\?:([a-z0-9|-]+\|[a-z0-9|-]+)\)\\\.')
+# too common to tell anything about the site
+IGNORED_LABELS = {'www', 'm', 'co', 'com', 'org', 'net'}
+
+# sites that can be extracted from embed page by generic extractor when the main page has changed
+EMBED_REWRITES = {
+    'Instagram': lambda m: m.group('url') + '/embed/',
+}
+
+
+class ExtractorRouter:
+    """
+    Index of extractors by host labels found in their _VALID_URL,
+    so url is matched only against extractors of its site instead of all of them.
+    Extractors are kept in youtube_dl order, custom ones go first.
+    Works with lazy extractors too, their modules are imported only when the extractor is used.
+    """
+
+    def __init__(self):
+        self.index = {}
+        self.order = {}
+        # extractors that are not part of youtube_dl
+        self.custom = set()
+        self.resolved = 0
+        self.routed = 0
+        self.resolve_time = 0.0
+
+    def stats(self):
+        return {'extractors': len(self.order), 'labels': len(self.index),
+                'resolved': self.resolved, 'routed': self.routed, 'resolve_time': round(self.resolve_time, 6)}
+
+    def add(self, ie, order):
+        valid_url = getattr(ie, '_VALID_URL', None)
+        if not valid_url or ie.ie_key() == 'Generic':
+            return
+        self.order[ie] = order
+        labels = set(host_label_re.findall(valid_url))
+        for group in host_group_re.findall(valid_url):
+            labels.update(group.split('|'))
+        for label in labels - IGNORED_LABELS:
+            self.index.setdefault(label, []).append(ie)
+
+    def build(self, ies, custom_ies=()):
+        self.index = {}
+        self.order = {}
+        self.custom = set(custom_ies)
+        for i, ie in enumerate(custom_ies):
+            self.add(ie, i - len(custom_ies))
+        for i, ie in enumerate(ies):
+            if ie.ie_key() not in {c.ie_key() for c in custom_ies}:
+                self.add(ie, i)
+        for ies in self.index.values():
+            ies.sort(key=lambda ie: self.order[ie])
+
+    def candidates(self, url):
+        host = urlparse(url).hostname or ''
+        found = set()
+        for label in host.lower().split('.')[:-1]:
+            found.update(self.index.get(label, ()))
+        return sorted(found, key=lambda ie: self.order[ie])
+
+    def resolve(self, url):
+        # returns extractor class or None if url should be matched against all extractors
+        started = time.perf_counter()
+        self.resolved += 1
+        try:
+            for ie in self.candidates(url):
+                if ie.suitable(url):
+                    self.routed += 1
+                    return ie
+            return None
+        finally:
+            self.resolve_time += time.perf_counter() - started
+
+    def embed_url(self, url):
+        ie = self.resolve(url)
+        if ie is None or ie.ie_key() not in EMBED_REWRITES:
+            return None
+        return EMBED_REWRITES[ie.ie_key()](re.match(ie._VALID_URL, url))
+
+
+router = ExtractorRouter()
@@ -17,6 +17,7 @@ from telethon.network import MTProtoSender
 from telethon.tl.functions.auth import ExportAuthorizationRequest, ImportAuthorizationRequest
 from telethon.tl.functions.upload import (GetFileRequest, SaveFilePartRequest,
                                           SaveBigFilePartRequest)
+from telethon.tl.tlobject import TLObject
 from telethon.tl.types import (Document, InputFileLocation, InputDocumentFileLocation,
                                InputPhotoFileLocation, InputPeerPhotoFileLocation, TypeInputFile,
                                InputFileBig, InputFile)
@@ -27,6 +28,36 @@ TypeLocation = Union[Document, InputDocumentFileLocation, InputPeerPhotoFileLoca
                      InputFileLocation, InputPhotoFileLocation]
 
 
+# Telegram requires saveBigFilePart for files above this size
+SMALL_FILE_MAX_SIZE = 10 * 1024 * 1024
+# part size used when the total size isn't known, it's the maximum allowed one
+STREAM_PART_SIZE = 512 * 1024
+
+
+class PartViewMixin:
+    # parts of local files are memoryviews of their mmap, telethon serializes only bytes
+    @staticmethod
+    def serialize_bytes(data):
+        if not isinstance(data, memoryview):
+            return TLObject.serialize_bytes(data)
+        n = len(data)
+        if n < 254:
+            header = bytes([n])
+            padding = -(n + 1) % 4
+        else:
+            header = bytes([254, n % 256, (n >> 8) % 256, (n >> 16) % 256])
+            padding = -n % 4
+        return b''.join((header, data, bytes(padding)))
+
+
+class SaveFilePartViewRequest(PartViewMixin, SaveFilePartRequest):
+    pass
+
+
+class SaveBigFilePartViewRequest(PartViewMixin, SaveBigFilePartRequest):
+    pass
+
+
 async def stream_file(file_to_stream: BinaryIO, chunk_size=1024):
     while True:
         data_read = await file_to_stream.read(chunk_size)
@@ -35,6 +66,19 @@ async def stream_file(file_to_stream: BinaryIO, chunk_size=1024):
         yield data_read
 
 
+async def stream_parts(file_to_stream: BinaryIO, part_size: int) -> AsyncGenerator[bytes, None]:
+    # every part except the last one must be exactly part_size long,
+    # so regroup short reads of pipes and sockets
+    buffer = bytearray()
+    async for data in stream_file(file_to_stream, chunk_size=part_size):
+        buffer.extend(data)
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+    if len(buffer) > 0:
+        yield bytes(buffer)
+
+
 class DownloadSender:
     sender: MTProtoSender
     request: GetFileRequest
@@ -73,28 +117,34 @@ class UploadSender:
         self.sender = sender
         self.part_count = part_count
         if big:
-            self.request = SaveBigFilePartRequest(file_id, index, part_count, b"")
+            self.request = SaveBigFilePartViewRequest(file_id, index, part_count, b"")
         else:
-            self.request = SaveFilePartRequest(file_id, index, b"")
+            self.request = SaveFilePartViewRequest(file_id, index, b"")
         self.stride = stride
         self.previous = None
         self.loop = loop
 
-    async def next(self, data: bytes) -> None:
+    async def next(self, data: bytes, total_parts: Optional[int] = None) -> None:
         if self.previous:
             await self.previous
-        self.previous = self.loop.create_task(self._next(data))
+        self.previous = self.loop.create_task(self._next(data, total_parts))
 
-    async def _next(self, data: bytes) -> None:
+    async def _next(self, data: bytes, total_parts: Optional[int] = None) -> None:
         self.request.bytes = data
+        if total_parts is not None and isinstance(self.request, SaveBigFilePartRequest):
+            self.request.file_total_parts = total_parts
+            self.part_count = total_parts
         log.debug(f"Sending file part {self.request.file_part}/{self.part_count}"
                   f" with {len(data)} bytes")
         await self.sender.send(self.request)
         self.request.file_part += self.stride
 
-    async def disconnect(self) -> None:
+    async def wait(self) -> None:
         if self.previous:
             await self.previous
+
+    async def disconnect(self) -> None:
+        await self.wait()
         return await self.sender.disconnect()
 
 
@@ -196,10 +246,19 @@ class ParallelTransferrer:
         await self._init_upload(connection_count, file_id, part_count, is_large)
         return part_size, part_count, is_large
 
-    async def upload(self, part: bytes) -> None:
-        await self.senders[self.upload_ticker].next(part)
+    async def init_stream_upload(self, file_id: int, connection_count: int) -> int:
+        # part count is unknown until the stream ends, -1 tells telegram it will be sent with the last part
+        log.debug(f"Starting stream upload with {connection_count} connections")
+        await self._init_upload(connection_count, file_id, -1, True)
+        return STREAM_PART_SIZE
+
+    async def upload(self, part: bytes, total_parts: Optional[int] = None) -> None:
+        await self.senders[self.upload_ticker].next(part, total_parts)
         self.upload_ticker = (self.upload_ticker + 1) % len(self.senders)
 
+    async def wait_uploaded(self) -> None:
+        await asyncio.gather(*[sender.wait() for sender in self.senders])
+
     async def finish_upload(self) -> None:
         await self._cleanup()
 
@@ -242,12 +301,29 @@ async def _internal_transfer_to_telegram(client: TelegramClient,
                                          progress_callback: callable,
                                          max_connection=None
                                          ) -> Tuple[TypeInputFile, int]:
+    if file_size is None:
+        return await _internal_stream_to_telegram(client, response, file_name, max_connection=max_connection)
+
     file_id = helpers.generate_random_long()
     # file_size = os.path.getsize(response.name)
 
     hash_md5 = hashlib.md5()
     uploader = ParallelTransferrer(client)
     part_size, part_count, is_large = await uploader.init_upload(file_id, file_size, max_connection=max_connection)
+    if hasattr(response, 'read_part'):
+        # random access source, every sender reads own parts
+        try:
+            if not is_large:
+                hash_md5.update(response.read_part(0, file_size))
+            await asyncio.gather(*[_upload_strided(sender, response, part_size, part_count)
+                                   for sender in uploader.senders])
+        finally:
+            await uploader.finish_upload()
+        if is_large:
+            return InputFileBig(file_id, part_count, file_name), file_size
+        else:
+            return InputFile(file_id, part_count, file_name, hash_md5.hexdigest()), file_size
+
     buffer = bytearray()
     part_index = 0
     async for data in stream_file(response, chunk_size=part_size):
@@ -295,6 +371,72 @@ async def _internal_transfer_to_telegram(client: TelegramClient,
         return InputFile(file_id, part_count, file_name, hash_md5.hexdigest()), file_size
 
 
+async def _upload_strided(sender: UploadSender, response, part_size: int, part_count: int) -> None:
+    for part in range(sender.request.file_part, part_count, sender.stride):
+        await sender.next(response.read_part(part * part_size, part_size))
+
+
+async def _internal_stream_to_telegram(client: TelegramClient,
+                                       response: BinaryIO,
+                                       file_name,
+                                       max_connection=None
+                                       ) -> Tuple[TypeInputFile, int]:
+    file_id = helpers.generate_random_long()
+    parts = stream_parts(response, STREAM_PART_SIZE)
+
+    # hold the beginning of the stream back until it is clear which upload mode it needs
+    head = []
+    head_size = 0
+    async for data in parts:
+        head.append(data)
+        head_size += len(data)
+        if head_size > SMALL_FILE_MAX_SIZE:
+            break
+    else:
+        if head_size == 0:
+            # telegram rejects file without parts with unclear error later
+            raise ValueError('nothing to upload, ' + str(file_name) + ' is empty')
+        # stream ended below the big file limit so upload it as a regular small file
+        hash_md5 = hashlib.md5()
+        uploader = ParallelTransferrer(client)
+        await uploader.init_upload(file_id, head_size, part_size_kb=STREAM_PART_SIZE // 1024,
+                                   max_connection=max_connection)
+        for data in head:
+            hash_md5.update(data)
+            await uploader.upload(data)
+        await uploader.finish_upload()
+        return InputFile(file_id, len(head), file_name, hash_md5.hexdigest()), head_size
+
+    uploader = ParallelTransferrer(client)
+    await uploader.init_stream_upload(file_id, max_connection or 2)
+
+    async def all_parts():
+        for _data in head:
+            yield _data
+        async for _data in parts:
+            yield _data
+
+    part_count = 0
+    file_size = 0
+    pending = None
+    try:
+        # keep one part in hand, the last one must carry the final part count
+        async for data in all_parts():
+            if pending is not None:
+                await uploader.upload(pending)
+                part_count += 1
+            pending = data
+            file_size += len(data)
+        head.clear()
+        part_count += 1
+        await uploader.wait_uploaded()
+        await uploader.upload(pending, total_parts=part_count)
+    finally:
+        await uploader.finish_upload()
+
+    return InputFileBig(file_id, part_count, file_name), file_size
+
+
 async def download_file(client: TelegramClient,
                                         location: TypeLocation,
                                         out: BinaryIO,
@@ -317,7 +459,7 @@ async def download_file(client: TelegramClient,
 
 async def upload_file(client: TelegramClient,
                                         file: BinaryIO,
-                                        file_size,
+                                        file_size: Optional[int],
                                         file_name,
                                         progress_callback: callable = None,
                                         max_connection=None
@@ -0,0 +1,186 @@
+import os
+
+TG_MAX_FILE_SIZE = 2000 * 1024 * 1024
+# relative error of size estimated from bitrate
+ESTIMATE_MARGIN = float(os.getenv('SIZE_ESTIMATE_MARGIN', 0.1))
+
+# youtube_dl selection on extraction, the real choice is done by select() from the whole formats list
+EXTRACT_FORMAT = 'best/bestvideo+bestaudio/bestvideo/bestaudio'
+
+UNSUPPORTED_PROTOCOLS = ['rtsp', 'rtmp', 'rtmpe', 'mms', 'f4m', 'ism', 'http_dash_segments']
+
+# keys copied from the chosen format to the entry by youtube_dl
+FORMAT_KEYS = ['url', 'manifest_url', 'ext', 'format', 'format_id', 'format_note', 'width', 'height', 'resolution',
+               'tbr', 'abr', 'acodec', 'asr', 'vbr', 'fps', 'vcodec', 'container', 'filesize', 'filesize_approx',
+               'player_url', 'protocol', 'fragment_base_url', 'fragments', 'preference', 'language',
+               'language_preference', 'quality', 'source_preference', 'http_headers', 'stretched_ratio', 'no_resume',
+               'downloader_options', 'requested_formats']
+
+
+class FormatSpec:
+    """
+    Preferred media of the user, video heights are split to tiers like 1080p is (720, 1080].
+    """
+
+    def __init__(self, max_height=None, audio=False):
+        self.max_height = max_height
+        self.audio = audio
+
+    def __repr__(self):
+        return 'audio' if self.audio else '{}p'.format(self.max_height)
+
+
+VIDEO_TIERS = [360, 720, 1080]
+
+
+def height_tier(height, max_height):
+    # bigger is better, 0 for formats above max height or without height
+    if not height:
+        return 0
+    tiers = [t for t in VIDEO_TIERS if t <= max_height] if max_height else VIDEO_TIERS
+    if max_height and height > max_height:
+        return 0
+    for i, tier in enumerate(tiers):
+        if height <= tier:
+            return i + 1
+    return len(tiers)
+
+
+def has_video(f):
+    return f.get('vcodec') != 'none'
+
+
+def has_audio(f):
+    return f.get('acodec') != 'none'
+
+
+def is_http(f):
+    return f.get('protocol', '').startswith('http') and f.get('protocol') not in UNSUPPORTED_PROTOCOLS
+
+
+def known_size(f):
+    size = f.get('filesize') or f.get('filesize_approx')
+    if isinstance(size, (int, float)) and size > 0:
+        return int(size)
+    return None
+
+
+def estimate_size(f, duration=None):
+    """
+    Size from extractor data without network requests, None if it can't be estimated.
+    """
+    size = known_size(f)
+    if size is not None:
+        return size
+    if not duration:
+        return None
+    # kbit/s, tbr of hls formats is taken from BANDWIDTH of master playlist
+    bitrate = f.get('tbr')
+    if not bitrate and (f.get('vbr') or f.get('abr')):
+        bitrate = (f.get('vbr') or 0) + (f.get('abr') or 0)
+    if not bitrate:
+        return None
+    return int(bitrate * 1000 / 8 * duration)
+
+
+def near_limit(size, limit=TG_MAX_FILE_SIZE, margin=ESTIMATE_MARGIN):
+    # estimated size can't tell on which side of the limit real size is
+    return size * (1 - margin) <= limit < size * (1 + margin)
+
+
+def plan_size(plan, estimate=known_size):
+    sizes = [estimate(f) for f in plan]
+    if any(s is None for s in sizes):
+        return None
+    return sum(sizes)
+
+
+def audio_key(f):
+    return (is_http(f) and f.get('ext') in ('m4a', 'mp3'),
+            f.get('ext') in ('m4a', 'mp3', 'mp4'),
+            is_http(f),
+            f.get('abr') or f.get('tbr') or 0)
+
+
+def video_key(plan, spec, max_size, estimate):
+    f = plan[0]
+    size = plan_size(plan, estimate)
+    return (size is None or size <= max_size,
+            f.get('ext') == 'mp4',
+            height_tier(f.get('height'), spec.max_height),
+            len(plan) == 1,
+            all(is_http(p) for p in plan),
+            f.get('height') or 0,
+            f.get('tbr') or 0)
+
+
+def usable(f):
+    if f.get('protocol') in UNSUPPORTED_PROTOCOLS or not f.get('url'):
+        return False
+    return not (f.get('vcodec') or '').startswith('av01')
+
+
+def rank(formats, spec, max_size=TG_MAX_FILE_SIZE, estimate=known_size):
+    """
+    Returns list of plans from the best one, plan is [format] or [video, audio].
+    """
+    formats = [f for f in formats if usable(f)]
+    audios = sorted([f for f in formats if has_audio(f) and not has_video(f)], key=audio_key, reverse=True)
+    if spec.audio:
+        progressive = [f for f in formats if has_audio(f)]
+        return [[f] for f in sorted(progressive,
+                                    key=lambda f: (not has_video(f),
+                                                   audio_key(f),
+                                                   f.get('ext') == 'mp4' and (f.get('height') or 0) <= 480),
+                                    reverse=True)]
+
+    plans = []
+    for f in formats:
+        if not has_video(f):
+            continue
+        if has_audio(f):
+            plans.append([f])
+        elif len(audios) > 0:
+            plans.append([f, audios[0]])
+        else:
+            plans.append([f])
+    plans.sort(key=lambda p: video_key(p, spec, max_size, estimate), reverse=True)
+    if len(plans) == 0:
+        # nothing looks like video, take what youtube_dl would take as "best"
+        plans = [[f] for f in reversed(formats)]
+    return plans
+
+
+def apply_plan(entry, plan):
+    for key in FORMAT_KEYS:
+        entry.pop(key, None)
+    if len(plan) == 1:
+        entry.update(plan[0])
+        return entry
+    video, audio = plan
+    entry.update(video)
+    entry['requested_formats'] = plan
+    entry['format_id'] = video.get('format_id', '') + '+' + audio.get('format_id', '')
+    entry['acodec'] = audio.get('acodec')
+    entry['abr'] = audio.get('abr')
+    entry.pop('filesize', None)
+    return entry
+
+
+def select(vinfo, spec, max_size=TG_MAX_FILE_SIZE, estimate=None):
+    # chooses formats of every entry in place, vinfo can be playlist
+    if vinfo.get('_type') in ('playlist', 'multi_video'):
+        for e in vinfo.get('entries') or []:
+            if e is not None:
+                select(e, spec, max_size, estimate)
+        return vinfo
+    formats = vinfo.get('formats')
+    if not formats:
+        return vinfo
+    if estimate is None:
+        duration = vinfo.get('duration')
+        estimate = lambda f: estimate_size(f, duration)
+    plans = rank(formats, spec, max_size, estimate)
+    if len(plans) != 0:
+        apply_plan(vinfo, plans[0])
+    return vinfo
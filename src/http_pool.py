@@ -0,0 +1,180 @@
+import functools
+import http.client
+import os
+import select
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# idle connections kept for every host
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 8))
+# seconds idle connection is kept open
+HTTP_POOL_IDLE_TIMEOUT = int(os.getenv('HTTP_POOL_IDLE_TIMEOUT', 60))
+
+# errors of connection closed by server while it was idle
+STALE_ERRORS = (ConnectionError, http.client.BadStatusLine, http.client.CannotSendRequest)
+
+
+class PooledResponse(http.client.HTTPResponse):
+    """
+    Returns connection to the pool when the body is read to the end.
+    """
+    release = None
+
+    def _close_conn(self):
+        super()._close_conn()
+        release, self.release = self.release, None
+        if release is not None and not self.will_close:
+            release()
+
+    def close(self):
+        if self.fp is not None:
+            # unread body is left in the socket
+            self.release = None
+        super().close()
+
+
+class ConnectionPool:
+    """
+    Keep-alive connections shared by all YoutubeDL instances,
+    connection is taken out of the pool while a request uses it so it's safe for extraction threads.
+    """
+
+    def __init__(self, size=HTTP_POOL_SIZE, idle_timeout=HTTP_POOL_IDLE_TIMEOUT):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.expired = 0
+        self.retried = 0
+
+    def stats(self):
+        with self._lock:
+            idle = sum(len(conns) for conns in self._idle.values())
+            hosts = len(self._idle)
+        return {'hosts': hosts, 'idle': idle, 'created': self.created, 'reused': self.reused,
+                'expired': self.expired, 'retried': self.retried}
+
+    @staticmethod
+    def _is_alive(conn):
+        # idle connection with something to read is closed by server
+        if conn.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return len(readable) == 0
+
+    def get(self, key):
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                conns = self._idle.get(key)
+                if not conns:
+                    return None
+                conn, released_at = conns.pop()
+                if len(conns) == 0:
+                    del self._idle[key]
+            if now - released_at < self.idle_timeout and self._is_alive(conn):
+                self.reused += 1
+                return conn
+            self.expired += 1
+            conn.close()
+
+    def put(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.size:
+                conns.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def _connect(self, http_class, req, debuglevel, tunnel_headers, **http_conn_args):
+        conn = http_class(req.host, timeout=req.timeout, **http_conn_args)
+        conn.response_class = PooledResponse
+        conn.set_debuglevel(debuglevel)
+        if req._tunnel_host:
+            conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+        self.created += 1
+        return conn
+
+    def do_open(self, handler, http_class, req, **http_conn_args):
+        """
+        urllib's AbstractHTTPHandler.do_open which doesn't close the connection after response.
+        """
+        if not req.host:
+            raise urllib.error.URLError('no host given')
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers = {name.title(): val for name, val in headers.items()}
+        headers['Connection'] = 'keep-alive'
+        tunnel_headers = {}
+        if req._tunnel_host and 'Proxy-Authorization' in headers:
+            tunnel_headers['Proxy-Authorization'] = headers.pop('Proxy-Authorization')
+
+        # youtube_dl passes connection factory with connection class in its arguments
+        conn_class = http_class.args[1] if isinstance(http_class, functools.partial) else http_class
+        context = http_conn_args.get('context')
+        key = (req.type, req.host, req._tunnel_host, conn_class,
+               context.verify_mode if context is not None else None)
+
+        conn = self.get(key)
+        reused = conn is not None
+        if reused:
+            conn.timeout = req.timeout
+            conn.sock.settimeout(req.timeout)
+        else:
+            conn = self._connect(http_class, req, handler._debuglevel, tunnel_headers, **http_conn_args)
+        while True:
+            try:
+                conn.request(req.get_method(), req.selector, req.data, headers,
+                             encode_chunked=req.has_header('Transfer-encoding'))
+                resp = conn.getresponse()
+                break
+            except STALE_ERRORS as err:
+                conn.close()
+                if not reused:
+                    raise urllib.error.URLError(err)
+                # server closed the idle connection, request wasn't processed
+                self.retried += 1
+                reused = False
+                conn = self._connect(http_class, req, handler._debuglevel, tunnel_headers, **http_conn_args)
+            except OSError as err:
+                conn.close()
+                raise urllib.error.URLError(err)
+            except:
+                conn.close()
+                raise
+
+        resp.url = req.get_full_url()
+        resp.msg = resp.reason
+        if not resp.will_close:
+            resp.release = functools.partial(self.put, key, conn)
+            if resp.length == 0:
+                # HEAD or empty body, nothing to wait for
+                resp._close_conn()
+        return resp
+
+
+def install(ydl, pool=None):
+    # makes http(s) requests of YoutubeDL instance go through shared keep-alive connections,
+    # its headers and cookies are still added by its own opener
+    pool = pool or default_pool
+    for handler in ydl._opener.handlers:
+        if isinstance(handler, urllib.request.AbstractHTTPHandler):
+            handler.do_open = functools.partial(pool.do_open, handler)
+    return ydl
+
+
+default_pool = ConnectionPool()
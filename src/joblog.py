@@ -0,0 +1,170 @@
+import contextvars
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+INSTANCE_ID = str(os.getenv('INSTANCE_INDEX', 0))
+# text keeps the old "LEVEL<chat>[msg](instance): message" lines, json writes one object per line
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+# records written at once by the writer thread
+LOG_BATCH_SIZE = 256
+
+# chat and message of the job that runs in the current task, tasks copy it from their parent
+_job = contextvars.ContextVar('job', default=None)
+# names of open spans
+_spans = contextvars.ContextVar('spans', default=())
+
+
+class ContextFilter(logging.Filter):
+    """
+    Adds job context to records, it's read when the record is made so the writer thread doesn't need it.
+    """
+
+    def filter(self, record):
+        job = _job.get()
+        record.id = job['chat_id'] if job else '-'
+        record.msgid = job['msg_id'] if job else '-'
+        record.in_id = INSTANCE_ID
+        record.span = '/'.join(_spans.get())
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    FIELDS = ('duration', 'error')
+
+    def format(self, record):
+        data = {'ts': round(record.created, 3), 'level': record.levelname, 'chat_id': record.id,
+                'msg_id': record.msgid, 'instance': record.in_id, 'msg': record.getMessage()}
+        if record.span:
+            data['span'] = record.span
+        for f in self.FIELDS:
+            if hasattr(record, f):
+                data[f] = getattr(record, f)
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class BatchHandler(logging.Handler):
+    """
+    Queues formatted records, writer thread drains the queue and writes them with one call,
+    so the event loop doesn't wait for stdout.
+    """
+
+    def __init__(self, stream=sys.stdout):
+        super().__init__()
+        self.stream = stream
+        self.queue = queue.SimpleQueue()
+        self.dropped = 0
+        self.written = 0
+        self._writer = threading.Thread(target=self._write_loop, name='log-writer', daemon=True)
+        self._writer.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put(self.format(record))
+        except Exception:
+            self.handleError(record)
+            return
+        if record.levelno >= logging.CRITICAL:
+            # fatal errors are followed by abort
+            self.flush()
+
+    def _write_loop(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < LOG_BATCH_SIZE:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = [i for i in items if isinstance(i, str)]
+            try:
+                if len(lines) != 0:
+                    self.stream.write('\n'.join(lines) + '\n')
+                    self.stream.flush()
+                    self.written += len(lines)
+            except Exception:
+                self.dropped += len(lines)
+            for i in items:
+                if isinstance(i, threading.Event):
+                    i.set()
+
+    def flush(self, timeout=2):
+        # waits until records queued before are written
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'written': self.written, 'dropped': self.dropped}
+
+
+def _new_logger():
+    logger = logging.getLogger('ytbdownbot')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    handler = BatchHandler()
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(levelname)s<%(id)s>[%(msgid)s](%(in_id)s): %(message)s"))
+    handler.addFilter(ContextFilter())
+    logger.addHandler(handler)
+    return logger, handler
+
+
+log, handler = _new_logger()
+
+
+def job(chat_id, msg_id):
+    # sets job context of the current task and returns the logger
+    _job.set({'chat_id': str(chat_id), 'msg_id': str(msg_id)})
+    return log
+
+
+class Span:
+    """
+    Timed stage of a job, logged with its duration when it ends.
+    Used as context manager or started and ended explicitly around code which is too long to indent.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+        self._token = None
+
+    def start(self):
+        self.started = time.monotonic()
+        self._token = _spans.set(_spans.get() + (self.name,))
+        return self
+
+    def end(self, error=None):
+        if self._token is None:
+            return
+        duration = time.monotonic() - self.started
+        extra = {'duration': round(duration, 3)}
+        if error is not None:
+            extra['error'] = type(error).__name__
+        log.debug('span {} took {:.3f}s'.format(self.name, duration) +
+                  (' with ' + extra['error'] if error is not None else ''), extra=extra)
+        try:
+            _spans.reset(self._token)
+        except ValueError:
+            # ended in another context
+            pass
+        self._token = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end(exc_val)
+
+
+def span(name):
+    return Span(name)
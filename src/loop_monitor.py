@@ -0,0 +1,115 @@
+import collections
+import os
+import sys
+import threading
+import time
+import traceback
+
+import joblog
+import metrics
+
+# seconds between event loop lag samples
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.1))
+# event loop blocked longer than this is reported with the stack of the blocking code,
+# it's counted from when the next lag sample was due, so up to LOOP_LAG_INTERVAL of the block isn't seen
+SLOW_CALLBACK_THRESHOLD = float(os.getenv('SLOW_CALLBACK_THRESHOLD', 0.5))
+# the same blocking place is reported with full stack once in this many seconds
+SLOW_CALLBACK_REPORT_INTERVAL = 60
+# recent lag samples used for percentiles
+LAG_WINDOW = 3000
+
+lag_seconds = metrics.register(metrics.Histogram('loop_lag_seconds', 'Delay of event loop timer callbacks'))
+slow_callbacks = metrics.register(metrics.Counter('slow_callbacks_total',
+                                                  'Event loop stalls over threshold by blocking function',
+                                                  ['where']))
+
+
+def _percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class LoopMonitor:
+    """
+    Samples event loop lag with a timer callback, watchdog thread captures the stack of the loop thread
+    while a callback blocks it longer than threshold.
+    """
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold=SLOW_CALLBACK_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.samples = collections.deque(maxlen=LAG_WINDOW)
+        self.loop = None
+        self.loop_thread = None
+        # when the next tick is due, written by the loop, read by the watchdog
+        self.due = None
+        self.stalls = 0
+        self.max_lag = 0.0
+        self._reported = {}
+        self._stalled_tick = None
+        self._stop = threading.Event()
+
+    def start(self, loop):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.due = time.monotonic() + self.interval
+        loop.call_later(self.interval, self._tick)
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _tick(self):
+        now = time.monotonic()
+        lag = max(0.0, now - self.due)
+        self.samples.append(lag)
+        self.max_lag = max(self.max_lag, lag)
+        lag_seconds.observe(lag)
+        if lag >= self.threshold:
+            joblog.log.warning('event loop was blocked for {:.3f}s'.format(lag))
+        if self._stop.is_set():
+            return
+        self.due = now + self.interval
+        self.loop.call_later(self.interval, self._tick)
+
+    def _watch(self):
+        while not self._stop.wait(min(self.threshold / 2, self.interval)):
+            due = self.due
+            if time.monotonic() - due < self.threshold or self._stalled_tick == due:
+                continue
+            # one report for every stall
+            self._stalled_tick = due
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            self.stalls += 1
+            self._report(traceback.extract_stack(frame))
+
+    def _report(self, stack):
+        # runs in the watchdog thread, logged at once in case the loop never gets free
+        # innermost frame of our code is what blocks, frames of libraries are below it
+        where = None
+        for f in reversed(stack):
+            if not f.filename.startswith((sys.prefix, sys.base_prefix)):
+                where = '{}:{}'.format(os.path.basename(f.filename), f.name)
+                break
+        if where is None:
+            where = '{}:{}'.format(os.path.basename(stack[-1].filename), stack[-1].name)
+        # metrics are changed only in the loop thread, it's counted when the loop is free again
+        self.loop.call_soon_threadsafe(lambda: slow_callbacks.inc(where=where))
+        now = time.monotonic()
+        if now - self._reported.get(where, float('-inf')) < SLOW_CALLBACK_REPORT_INTERVAL:
+            joblog.log.warning('event loop is blocked over {}s in {}'.format(self.threshold, where))
+            return
+        self._reported[where] = now
+        joblog.log.warning('event loop is blocked over {}s in {}, stack:\n{}'.format(
+            self.threshold, where, ''.join(traceback.format_list(stack)).rstrip()))
+
+    def stats(self):
+        samples = sorted(self.samples)
+        if len(samples) == 0:
+            return {'stalls': self.stalls}
+        return {'lag_p50': _percentile(samples, 0.5), 'lag_p90': _percentile(samples, 0.9),
+                'lag_p99': _percentile(samples, 0.99), 'lag_max': self.max_lag, 'stalls': self.stalls}
+
+
+monitor = LoopMonitor()
@@ -7,8 +7,6 @@ from telethon.errors import AuthKeyDuplicatedError, BadRequestError
 import traceback
 import asyncio
 import logging
-import logaugment
-import youtube_dl
 from aiohttp import web, ClientSession
 from urlextract import URLExtract
 import re
@@ -22,15 +20,21 @@ import io
 import inspect
 import mimetypes
 from datetime import time, timedelta
-from requests.exceptions import HTTPError as CloudantHTTPError
 from urllib.error import HTTPError
 from urllib.parse import urlparse, urlunparse
 import signal
-import functools
+import executors
+import format_select
+import extractor_router
 import fast_telethon
-import aiofiles
-from extractor.tiktok import TikTokIE
-from extractor.pinterest import PinterestIE
+import spill_buffer
+import spool
+import mirrors
+import http_pool
+import metrics
+import joblog
+import loop_monitor
+from time import monotonic
 
 
 def get_client_session():
@@ -64,45 +68,17 @@ def sizeof_fmt(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
-def new_logger(user_id, msg_id):
-    logger = logging.Logger('')
-    logger.setLevel(logging.DEBUG)
-    handler = logging.StreamHandler(sys.stdout)
-    instance_id = os.getenv('INSTANCE_INDEX', 0)
-    formatter = logging.Formatter("%(levelname)s<%(id)s>[%(msgid)s](%(in_id)s): %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    logaugment.set(logger, id=str(user_id), msgid=str(msg_id), in_id=str(instance_id))
-
-    return logger
-
-
 async def on_callback(callback):
     from_id = callback['from']['id']
     msg_id = callback['message']['message_id']
     data = callback['data']
     user = await users.User.init(from_id)
-    log = new_logger(from_id, msg_id)
-    # retry in case of update conflict
-    for _ in range(15):
-        try:
-            await _on_callback(from_id, msg_id, data, user, log)
-        except CloudantHTTPError as e:
-            if e.response.status_code == 409:
-                log.warning('document update conflict, trying sync with db...')
-                try:
-                    await user.sync_with_db()
-                except CloudantHTTPError as e:
-                    if e.response.status_code == 404:
-                        user = await users.User.init(from_id, force_create=True)
-                continue
-            else:
-                log.exception(e)
-                break
-        except Exception as e:
-            log.exception(e)
-            break
-        break
+    log = joblog.job(from_id, msg_id)
+    # settings are written in background, update conflicts are merged by users.settings_writer
+    try:
+        await _on_callback(from_id, msg_id, data, user, log)
+    except Exception as e:
+        log.exception(e)
 
 
 async def _on_callback(from_id, msg_id, data, user, log):
@@ -146,7 +122,29 @@ async def _on_callback(from_id, msg_id, data, user, log):
 async def on_message(request):
     try:
         req_data = await request.json()
+    except Exception as e:
+        print(e)
+        traceback.print_exc()
+        return web.Response(status=200)
+    if not startup_done.is_set():
+        # webhook is up before the client is started, updates wait for it
+        asyncio.get_event_loop().create_task(on_queued_update(req_data))
+        return web.Response(status=200)
+    return on_update(req_data)
+
+
+async def on_queued_update(req_data):
+    global QUEUED_UPDATES
+    QUEUED_UPDATES += 1
+    try:
+        await startup_done.wait()
+    finally:
+        QUEUED_UPDATES -= 1
+    on_update(req_data)
+
 
+def on_update(req_data):
+    try:
         if 'callback_query' in req_data:
             asyncio.get_event_loop().create_task(on_callback(req_data['callback_query']))
             return web.Response(status=200)
@@ -169,6 +167,7 @@ async def task_timeout_cancel(task, timemout=5):
         task.cancel()
 
 async def _on_message_task(message):
+    metrics.active_jobs.inc()
     try:
         # async with bot.action(message['chat']['id'], 'file'):
         chat_id = message['chat']['id']
@@ -176,7 +175,7 @@ async def _on_message_task(message):
         is_group = False
         if message['chat']['type'] != 'private':
             is_group = True
-        log = new_logger(chat_id, msg_id)
+        log = joblog.job(chat_id, msg_id)
         try:
             await _on_message(message, log, is_group)
         except HTTPError as e:
@@ -184,6 +183,7 @@ async def _on_message_task(message):
             # otherwise youtube.com will not allow us
             # to download any video for some time
             log.exception(e)
+            metrics.errors.inc(type='HTTPError')
             if not is_group:
                 await client.send_message(chat_id, e.__str__(), reply_to=msg_id)
         except youtube_dl.DownloadError as e:
@@ -191,10 +191,12 @@ async def _on_message_task(message):
             # otherwise youtube.com will not allow us
             # to download any video for some time
             log.exception(e)
+            metrics.errors.inc(type='DownloadError')
             if not is_group:
                 await client.send_message(chat_id, str(e), reply_to=msg_id)
         except Exception as e:
             log.exception(e)
+            metrics.errors.inc(type=type(e).__name__)
             if 'ERROR' not in str(e):
                 err_msg = 'ERROR: ' + str(e)
             else:
@@ -203,6 +205,8 @@ async def _on_message_task(message):
                 await client.send_message(chat_id, err_msg, reply_to=msg_id)
     except Exception as e:
         logging.error(e)
+    finally:
+        metrics.active_jobs.dec()
 
 
 # extract telegram command from message
@@ -227,12 +231,41 @@ async def extract_url_info(ydl, url):
     # async with ClientSession() as session:
     #     async with session.post(YTDL_LAMBDA_URL, json=data, headers=headers, timeout=14400) as req:
     #         return await req.json()
-    return await asyncio.get_event_loop().run_in_executor(None,
-                                                          functools.partial(ydl.extract_info,
-                                                                            download=False,
-                                                                            force_generic_extractor=ydl.params.get(
-                                                                                'force_generic_extractor', False)),
-                                                          url)
+    route = mirrors.pool.mirror_for(url) or (mirrors.pool.youtube if is_ytb_link_re.search(url) else None)
+    if route is not None:
+        # open route is still tried if the caller has no other choice
+        route.acquire_trial()
+    started = monotonic()
+    try:
+        vinfo = await _extract_url_info(ydl, url)
+    except youtube_dl.DownloadError as e:
+        metrics.stage_seconds.observe(monotonic() - started, stage='extraction')
+        if route is not None:
+            too_many = e.exc_info is not None and e.exc_info[0] is HTTPError and e.exc_info[1].file.code == 429
+            if route is mirrors.pool.youtube and not too_many:
+                # youtube answered, the video itself is unavailable
+                route.success()
+            else:
+                route.failure(trip=too_many)
+        raise
+    metrics.stage_seconds.observe(monotonic() - started, stage='extraction')
+    if route is not None:
+        route.success(monotonic() - started)
+    return vinfo
+
+
+async def _extract_url_info(ydl, url):
+    force_generic = ydl.params.get('force_generic_extractor', False)
+    ie = None if force_generic else extractor_router.router.resolve(url)
+    if ie is None:
+        return await executors.extraction.run(ydl.extract_info,
+                                              url,
+                                              download=False,
+                                              force_generic_extractor=force_generic)
+    # straight to the extractor of the site, custom ones replace youtube_dl extractors with the same key
+    if ie in extractor_router.router.custom and not isinstance(ydl._ies_instances.get(ie.ie_key()), ie):
+        ydl.add_info_extractor(ie())
+    return await executors.extraction.run(ydl.extract_info, url, download=False, ie_key=ie.ie_key())
 
 
 async def send_settings(user, user_id, edit_id=None):
@@ -261,7 +294,6 @@ is_ytb_link_re = re.compile(
     '^((?:https?:)?\/\/)?((?:www|m|music)\.)?((?:youtube\.com|youtu.be))(\/(?:[\w\-]+\?v=|embed\/|v\/)?)([\w\-]+)(\S+)?$')
 get_ytb_id_re = re.compile(
     '.*(youtu.be\/|v\/|embed\/|watch\?|youtube.com\/user\/[^#]*#([^\/]*?\/)*)\??v?=?([^#\&\?]*).*')
-invidious_re = re.compile(r'https?://(?:www\.)?invidious\.snopyta\.org/watch\?v=(?P<id>[0-9A-Za-z_-]{11})')
 
 single_time_re = re.compile(' ((2[0-3]|[01]?[0-9]):)?(([0-5]?[0-9]):)?([0-5]?[0-9])(\\.[0-9]+)? ')
 
@@ -298,32 +330,75 @@ def normalize_url_path(url):
 
 
 def youtube_to_invidio(url, quality='dash'):
+    # None if it's not a youtube link or all mirrors are down
     u = None
-    if is_ytb_link_re.search(url):
+    mirror = mirrors.pool.best()
+    if mirror is not None and is_ytb_link_re.search(url):
         ytb_id_match = get_ytb_id_re.search(url)
         if ytb_id_match:
             ytb_id = ytb_id_match.groups()[-1]
-            u = "https://invidious.snopyta.org/watch?v=" + ytb_id + f"&quality={quality}"
+            u = "https://" + mirror.host + "/watch?v=" + ytb_id + f"&quality={quality}"
     return u
 
-async def upload_multipart_zip(source, name, file_size, chat_id, msg_id):
-    zfile = zip_file.ZipTorrentContentFile(source, name, file_size)
+async def format_size(f, duration, http_headers):
+    # size estimated from extractor data is enough unless it's close to telegram limit
+    if isinstance(f.get('filesize'), int) and f['filesize'] > 0:
+        return f['filesize']
+    size = format_select.estimate_size(f, duration)
+    if size is not None and not format_select.near_limit(size, TG_MAX_FILE_SIZE):
+        return size
+    url = f['url']
+    if mirrors.pool.is_mirror_url(url):
+        url = normalize_url_path(url)
+    with metrics.stage_seconds.time(stage='size_probe'):
+        if 'm3u8' in f.get('protocol', ''):
+            return await av_utils.m3u8_video_size(url, http_headers)
+        return await av_utils.media_size(url, http_headers=http_headers)
+
+
+def exact_source_size(source):
+    # only http Content-Length is trusted, other sizes are estimated, 0 means unknown
+    if isinstance(source, av_source.URLav) and source.request.content_length is not None and \
+            'Content-Encoding' not in source.request.headers:
+        return source.request.content_length
+    return 0
+
+
+async def upload_multipart_zip(source, name, chat_id, msg_id, raw=False):
+    zfile = zip_file.ZipTorrentContentFile(source, name, exact_source_size(source), raw=raw)
+    try:
+        await upload_zip_parts(zfile, chat_id, msg_id)
+    finally:
+        if source is not None:
+            if inspect.iscoroutinefunction(source.close):
+                await source.close()
+            else:
+                source.close()
+
 
-    async def upload_torrent_content(file, chat_id, msg_id):
+async def upload_zip_parts(zfile, chat_id, msg_id):
+    async def upload_torrent_content(file, part):
         global TG_CONNECTIONS_COUNT
         global TG_MAX_PARALLEL_CONNECTIONS
-        if 20 > TG_CONNECTIONS_COUNT and file.size > 100 * 1024 * 1024:
-            TG_CONNECTIONS_COUNT += 2
+        if part.size is None or (20 > TG_CONNECTIONS_COUNT and part.size > 100 * 1024 * 1024):
+            # part of unknown size can be uploaded only as stream, with one connection when all are busy
+            connections = 2 if 20 > TG_CONNECTIONS_COUNT else 1
+            TG_CONNECTIONS_COUNT += connections
             try:
-                uploaded_file = await fast_telethon.upload_file(client,
-                                                                file,
-                                                                file_size=file.size,
-                                                                file_name=file.name,
-                                                                max_connection=2)
+                return await fast_telethon.upload_file(client,
+                                                       file,
+                                                       file_size=part.size,
+                                                       file_name=part.name,
+                                                       max_connection=connections)
             finally:
-                TG_CONNECTIONS_COUNT -= 2
+                TG_CONNECTIONS_COUNT -= connections
         else:
-            uploaded_file = await client.upload_file(file, file_size=file.size, file_name=file.name)
+            return await client.upload_file(file, file_size=part.size, file_name=part.name)
+
+    async def send_torrent_content(uploaded_file, previous_send):
+        # keep parts order in chat
+        if previous_send is not None:
+            await previous_send
         for i in range(3):
             try:
                 await client.send_file(chat_id, uploaded_file, reply_to=msg_id)
@@ -335,30 +410,199 @@ async def upload_multipart_zip(source, name, file_size, chat_id, msg_id):
                 continue
             break
 
+    part = zip_file.ZipPart(zfile, 1)
+    part_buffer = spill_buffer.SpillBuffer(part)
+    next_buffer = None
+    send_task = None
     try:
-        for i in range(0, zfile.zip_parts):
-            await upload_torrent_content(zfile, chat_id, msg_id)
-            zfile.zip_num += 1
+        while True:
+            # next part is spooled from zip stream while current one is uploading
+            next_part = zip_file.ZipPart(zfile, part.num + 1, previous=part)
+            next_buffer = spill_buffer.SpillBuffer(next_part)
+            uploaded_file = await upload_torrent_content(part_buffer, part)
+            # single part of unknown size archive isn't numbered, it's known only when the part is read
+            uploaded_file.name = part.name
+            await part_buffer.close()
+            send_task = asyncio.get_event_loop().create_task(send_torrent_content(uploaded_file, send_task))
+            part, part_buffer, next_buffer = next_part, next_buffer, None
+            await part.ready.wait()
+            if part.empty:
+                break
+        await send_task
     except BadRequestError as e:
         logging.error(e)
+    finally:
+        await part_buffer.close()
+        if next_buffer is not None:
+            await next_buffer.close()
+
+
+async def open_playlist_entry(entry, audio_mode, referer, user_cookie):
+    # returns extension and background downloading source of playlist entry
+    formats = entry.get('requested_formats')
+    http_headers = entry.get('http_headers')
+    if http_headers is None and formats is not None:
+        http_headers = formats[0].get('http_headers')
+    http_headers = dict(http_headers or {})
+    if not entry.get('direct', False):
+        http_headers['Referer'] = referer
+    if user_cookie:
+        http_headers['Cookie'] = user_cookie
+
+    if formats is not None and len(formats) > 1 and not audio_mode:
+        source = await av_source.FFMpegAV.create(formats[0], formats[1], headers=http_headers, restrict_size=False)
+        ext = 'mp4'
+    else:
+        f = formats[0] if formats is not None else entry
+        if audio_mode and f.get('ext') != 'mp3':
+            source = await av_source.FFMpegAV.create(f, audio_only=True, headers=http_headers, restrict_size=False)
+            ext = 'mp3'
+        elif 'm3u8' in f.get('protocol', ''):
+            source = await av_source.FFMpegAV.create(f, headers=http_headers, ext=f.get('ext'), restrict_size=False)
+            ext = source.format or f.get('ext', 'mp4')
+        else:
+            source = await av_source.URLav.create(f['url'], http_headers)
+            ext = f.get('ext', 'bin')
+    return ext, spill_buffer.SpillBuffer(source)
+
 
-    if source is not None:
-        if inspect.iscoroutinefunction(source.close):
-            await source.close()
+async def resolve_playlist_entry(ydl, entry, spec):
+    # full info of flat playlist entry with chosen formats, None if extraction failed
+    if entry is not None and entry.get('_type') in ('url', 'url_transparent'):
+        try:
+            with metrics.stage_seconds.time(stage='extraction'):
+                entry = await executors.extraction.run(ydl.process_ie_result, dict(entry), download=False)
+        except youtube_dl.DownloadError:
+            return None
+    if entry is not None:
+        format_select.select(entry, spec)
+    return entry
+
+
+async def iter_playlist_entries(ydl, entries, spec, resolved, indexes):
+    # entries are extracted one by one when they are needed, so the first one doesn't wait for the others,
+    # resolved keeps extracted entries by index for retries with other formats, yields index and entry
+    for i in indexes:
+        entry = entries[i]
+        if i in resolved:
+            entry = resolved[i]
+            if entry is not None:
+                format_select.select(entry, spec)
         else:
-            source.close()
+            entry = await resolve_playlist_entry(ydl, entry, spec)
+            resolved[i] = entry
+        yield i, entry
+
+
+async def upload_playlist_archive(entries, name, audio_mode, chat_id, msg_id, referer, user_cookie, log,
+                                  resolve=None, first_index=1):
+    # whole playlist goes to one archive, few entries ahead are downloaded in background
+    # while the current one is written, entries of flat playlist are extracted by resolve,
+    # first_index is playlist index of the first entry
+    indexes = [first_index + i for i, e in enumerate(entries) if e is not None]
+    entries = [e for e in entries if e is not None]
+    tasks = [None] * len(entries)
+    skipped = []
+    resolve_lock = asyncio.Lock()
+
+    async def _open_entry(entry):
+        if resolve is not None:
+            # resolve uses one YoutubeDL which isn't thread safe, so entries are extracted one at a time,
+            # downloads of extracted ones still go in parallel
+            async with resolve_lock:
+                entry = await resolve(entry)
+            if entry is None:
+                raise Exception('failed extract entry')
+        return await open_playlist_entry(entry, audio_mode, referer, user_cookie)
+
+    def start(i):
+        if i < len(entries) and tasks[i] is None:
+            tasks[i] = asyncio.get_event_loop().create_task(_open_entry(entries[i]))
+
+    async def closing_iter(buffer):
+        try:
+            async for data in buffer:
+                yield data
+        finally:
+            await buffer.close()
+
+    def opener(i):
+        async def _open():
+            for j in range(i, i + PLAYLIST_ARCHIVE_PREFETCH + 1):
+                start(j)
+            entry = entries[i]
+            index = entry.get('playlist_index') or indexes[i]
+            try:
+                ext, buffer = await tasks[i]
+            except Exception as e:
+                log.warning('failed to open playlist entry: ' + str(e))
+                skipped.append(index)
+                return None
+            title = (entry.get('title') or str(index)).replace('/', '_')
+            return '{:03d} {}.{}'.format(index, title, ext), closing_iter(buffer), None
+        return _open
+
+    zfile = zip_file.ZipTorrentContentFile(None, name, 0, openers=[opener(i) for i in range(len(entries))])
+    try:
+        await upload_zip_parts(zfile, chat_id, msg_id)
+    finally:
+        for task in tasks:
+            if task is None:
+                continue
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                await task.result()[1].close()
+    if len(skipped) != 0:
+        await client.send_message(chat_id,
+                                  'WARN: ' + ', '.join('#' + str(s) for s in skipped) + ' was skipped due to error',
+                                  reply_to=msg_id)
+
+
+def artifact_key(entry, audio_mode, cut_time_range):
+    # identifies result of media processing for spool cache
+    return (entry.get('extractor_key'), entry.get('id'), entry.get('format_id'), audio_mode, cut_time_range)
+
+
+async def spooled_ffmpeg_av(key, file_size, file_name, *args, pipe_fallback=True, **kwargs):
+    # reuse cached remux file or remux to new spool reservation,
+    # media is piped if file_name is None or spool is full
+    if file_name is not None:
+        cached = spool.cache.get(key if key[1] is not None else None)
+        if cached is not None:
+            return av_source.FFMpegAV.from_file(cached.path, cached.format), cached
+        reservation = spool.manager.reserve(file_size, file_name)
+        if reservation is not None:
+            ffmpeg_av = await av_source.FFMpegAV.create(*args, file_name=reservation.path, **kwargs)
+            reservation.path = ffmpeg_av.file_name
+            reservation.key = key if key[1] is not None else None
+            return ffmpeg_av, reservation
+    if not pipe_fallback:
+        return None, None
+    return await av_source.FFMpegAV.create(*args, **kwargs), None
+
 
-            
 async def ytb_playlist_to_invidious(url, range, quality="dash"):
     invid_urls = []
     playlist_id_r = re.compile(r'list=((?:PL|LL|EC|UU|FL|RD|UL|TL|PU|OLAK5uy_)[0-9A-Za-z-_]{10,})')
     pid = playlist_id_r.search(url).groups()[0]
-    async with ClientSession() as session:
-        async with session.get("https://invidious.snopyta.org/api/v1/playlists/"+pid) as req:
-            invid_playlist = await req.json()
-    for iv in invid_playlist['videos'][range[0]-1:range[1]]:
-        invid_urls.append("https://invidious.snopyta.org/watch?v=" + iv['videoId'] + "&quality="+quality+("&raw=1" if quality != "dash" else ""))
-    return invid_urls
+    for mirror in mirrors.pool.ranked():
+        if not mirror.acquire_trial():
+            continue
+        started = monotonic()
+        try:
+            async with ClientSession() as session:
+                async with session.get("https://" + mirror.host + "/api/v1/playlists/" + pid) as req:
+                    req.raise_for_status()
+                    invid_playlist = await req.json()
+        except Exception:
+            mirror.failure()
+            continue
+        mirror.success(monotonic() - started)
+        for iv in invid_playlist['videos'][range[0]-1:range[1]]:
+            invid_urls.append("https://" + mirror.host + "/watch?v=" + iv['videoId'] + "&quality="+quality+("&raw=1" if quality != "dash" else ""))
+        return invid_urls
+    raise Exception('no available invidious mirror')
 
 
 def get_cookie_from_text(msg_txt):
@@ -387,8 +631,6 @@ def get_user_headers_from_text(msg_txt):
 
 
 async def _on_message(message, log, is_group):
-    global STORAGE_SIZE
-    global YT_TOO_MANY_REQUEST
     if message['from']['is_bot']:
         log.info('Message from bot, skip')
         return
@@ -421,6 +663,8 @@ async def _on_message(message, log, is_group):
     playlist_end = None
     y_format = None
     audio_mode = False
+    raw_split = False
+    playlist_archive = False
 
     user = None
     # check cmd and choose video format
@@ -432,6 +676,10 @@ async def _on_message(message, log, is_group):
         elif cmd == 'start':
             await client.send_message(chat_id, 'Send me a video links')
             return
+        elif cmd == 'zr':
+            # split file to parts without zip container
+            raw_split = True
+            cmd = 'z'
         elif cmd == 'c':
             try:
                 cut_time_start, cut_time_end = cut_time.parse_time(msg_txt)
@@ -514,6 +762,10 @@ async def _on_message(message, log, is_group):
                 #                        'Too big range. Allowed range is less or equal 50 videos',
                 #                        reply_to=msg_id)
                 return
+            # "z" suffix means send whole playlist as archive
+            if cmd.endswith('z'):
+                playlist_archive = True
+                cmd = cmd[:-1]
             # cut "p" from cmd variable if cmd == "pa" or "pw"
             cmd = cmd if len(cmd) == 1 else cmd[-1]
         if cmd == 'a':
@@ -559,12 +811,13 @@ async def _on_message(message, log, is_group):
         if is_group:
             group_username = message['chat']['username']
             _from_id = message['from']['id']
-            is_user_sane = await users.is_user_sane(_from_id)
+            # both documents are read with one batched request
+            is_user_sane, user = await asyncio.gather(users.is_user_sane(_from_id),
+                                                      users.User.init(chat_id, username=group_username, is_group=is_group))
             if not is_user_sane:
                 raise Exception('Bad user')
         else:
-            group_username = None
-        user = await users.User.init(chat_id, username=group_username, is_group=is_group)
+            user = await users.User.init(chat_id, is_group=is_group)
     if user.default_media_type == users.DefaultMediaType.Audio.value:
         audio_mode = True
 
@@ -586,7 +839,7 @@ async def _on_message(message, log, is_group):
 
     # await _bot.send_chat_action(chat_id, "upload_document")
 
-    if YT_TOO_MANY_REQUEST and 'youtube.com/playlist?list=' in urls[0] and playlist_start is not None:
+    if not mirrors.pool.youtube.available() and 'youtube.com/playlist?list=' in urls[0] and playlist_start is not None:
         try:
             if audio_mode:
                 urls = await ytb_playlist_to_invidious(urls[0], (playlist_start,playlist_end))
@@ -605,10 +858,12 @@ async def _on_message(message, log, is_group):
                       'is_group': True,
                       'no_color': True,
                       'nocheckcertificate': True,
-                      'force_generic_extractor': True if invidious_re.search(u) else False
+                      'force_generic_extractor': True if mirrors.pool.watch_re.search(u) else False
                       }
-            if playlist_start != None and playlist_end != None: #and 'invidious.snopyta.org/watch' not in u:
+            if playlist_start != None and playlist_end != None: #and not mirrors.pool.watch_re.search(u):
                 params['ignoreerrors'] = True
+                # only list entries, they are extracted one by one while processing
+                params['extract_flat'] = 'in_playlist'
                 if playlist_start == 0 and playlist_end == 0:
                     params['playliststart'] = 1
                     params['playlistend'] = 10
@@ -620,7 +875,7 @@ async def _on_message(message, log, is_group):
             if user_uname and user_passwd:
                 params['username'] = user_uname
                 params['password'] = user_passwd
-            ydl = youtube_dl.YoutubeDL(params=params)
+            ydl = http_pool.install(youtube_dl.YoutubeDL(params=params))
             if user_cookie:
                 if ydl._opener.addheaders is None:
                     ydl._opener.addheaders = []
@@ -631,25 +886,32 @@ async def _on_message(message, log, is_group):
                     ydl._opener.addheaders = []
                 for k, v in user_headers.items():
                     ydl._opener.addheaders.append((k, v))
-            recover_playlist_index = None  # to save last playlist position if finding format failed
+            # indexes of entries which are tried again with the next preferred format, None if all are sent
+            retry_entries = None
+            resolved_entries = {}
             for ip, pref_format in enumerate(preferred_formats):
+                extract_span = joblog.span('extract').start()
                 try:
-                    params['format'] = pref_format
-                    if recover_playlist_index is not None and 'playliststart' in params:
-                        params['playliststart'] += recover_playlist_index
+                    params['format'] = format_select.EXTRACT_FORMAT
                     ydl.params = params
                     if vinfo is None:
+                        ytb_url = u
                         for i_ in range(2):
+                            mirror_url = None
                             try:
-                                # use invidious.snopyta.org for youtube links from groups to prevent 429 err
-                                if is_group and invidious_re.search(u):
+                                # use invidious mirror for youtube links from groups and while youtube blocks us
+                                # to prevent 429 err
+                                if i_ == 0 and is_ytb_link_re.search(u) and \
+                                        (is_group or not mirrors.pool.youtube.available()):
                                     if audio_mode:
-                                        u = youtube_to_invidio(u)
+                                        mirror_url = youtube_to_invidio(u)
                                     else:
-                                        u = youtube_to_invidio(u, quality='hd720')
-                                    ydl.params['force_generic_extractor'] = True
+                                        mirror_url = youtube_to_invidio(u, quality='hd720')
+                                    if mirror_url:
+                                        u = mirror_url
+                                        ydl.params['force_generic_extractor'] = True
                                 vinfo = await extract_url_info(ydl, u)
-                                if is_group and invidious_re.search(u):
+                                if mirror_url:
                                     try:
                                         vinfo['entries'][0]['url'] = u + ('&raw=1' if not audio_mode else '')
                                     except:
@@ -657,7 +919,12 @@ async def _on_message(message, log, is_group):
                                 if vinfo.get('age_limit') == 18 and is_ytb_link_re.search(vinfo.get('webpage_url', '')):
                                     raise youtube_dl.DownloadError('youtube age limit')
                             except youtube_dl.DownloadError as e:
-                                # try to use invidious.snopyta.org youtube frontend to bypass 429 block
+                                if mirror_url:
+                                    # mirror failed, try youtube itself
+                                    u = ytb_url
+                                    ydl.params['force_generic_extractor'] = False
+                                    continue
+                                # try to use invidious youtube frontend to bypass 429 block
                                 if (e.exc_info is not None and e.exc_info[0] is HTTPError and e.exc_info[
                                     1].file.code == 429) or \
                                         'video available in your country' in str(e) or \
@@ -669,38 +936,24 @@ async def _on_message(message, log, is_group):
                                     else:
                                         invid_url = youtube_to_invidio(u, quality='hd720&raw=1')
                                     if invid_url:
-                                        if e.exc_info[1].file.code == 429:
-                                            YT_TOO_MANY_REQUEST = True
                                         u = invid_url
                                         ydl.params['force_generic_extractor'] = True
                                         continue
                                     raise
                                 elif e.exc_info is not None and e.exc_info[0] is youtube_dl.utils.UnsupportedError:
-                                    tk = TikTokIE()
-                                    pn = PinterestIE()
-                                    if tk.suitable(u) or (len(e.exc_info) > 1 and tk.suitable(e.exc_info[1].url)):
-                                        # Tiktok inject
-                                        ydl.add_info_extractor(tk)
-                                        ydl._ies = [TikTokIE] + ydl._ies
-                                        if 'tiktok.com/@' not in u:
-                                            u = e.exc_info[1].url
-                                        vinfo = await extract_url_info(ydl, u)
-                                    elif pn.suitable(u) or (len(e.exc_info) > 1 and pn.suitable(e.exc_info[1].url)):
-                                        # Pinterest inject
-                                        ydl.add_info_extractor(pn)
-                                        ydl._ies = [PinterestIE] + ydl._ies
-                                        if 'pin.it' in u:
-                                            u = e.exc_info[1].url
-                                        vinfo = await extract_url_info(ydl, u)
-                                    else:
+                                    # short links like pin.it are routed only after redirect
+                                    redirect_url = e.exc_info[1].url if len(e.exc_info) > 1 else None
+                                    if redirect_url is None or redirect_url == u or \
+                                            extractor_router.router.resolve(redirect_url) is None:
                                         raise
+                                    u = redirect_url
+                                    vinfo = await extract_url_info(ydl, u)
                                 elif e.exc_info is not None and e.exc_info[0] is youtube_dl.utils.RegexNotFoundError:
                                     # Temp fix for instagram.com
-                                    iie = youtube_dl.extractor.instagram.InstagramIE()
-                                    if not iie.suitable(u):
+                                    embed_url = extractor_router.router.embed_url(u)
+                                    if embed_url is None:
                                         raise
-                                    mobj = re.match(iie._VALID_URL, u)
-                                    u = mobj.group('url') + '/embed/'
+                                    u = embed_url
                                     ydl.params['force_generic_extractor'] = True
                                     vinfo = await extract_url_info(ydl, u)
                                     if 'entries' in vinfo:
@@ -714,21 +967,13 @@ async def _on_message(message, log, is_group):
                             break
 
                         log.debug('video info received')
-                    else:
-                        if '_type' in vinfo and vinfo['_type'] == 'playlist':
-                            for i, e in enumerate(vinfo['entries']):
-                                e['requested_formats'] = None
-                                vinfo['entries'][i] = ydl.process_video_result(e, download=False)
-                        else:
-                            vinfo['requested_formats'] = None
-                            vinfo = ydl.process_video_result(vinfo, download=False)
-                        log.debug('video info reprocessed with new format')
                 except Exception as e:
+                    extract_span.end(e)
                     if "Please log in or sign up to view this video" in str(e):
                         if 'vk.com' in u and 'username' not in params:
                             params['username'] = os.environ['VIDEO_ACCOUNT_USERNAME']
                             params['password'] = os.environ['VIDEO_ACCOUNT_PASSWORD']
-                            ydl = youtube_dl.YoutubeDL(params=params)
+                            ydl = http_pool.install(youtube_dl.YoutubeDL(params=params))
                             try:
                                 vinfo = await extract_url_info(ydl, u)
                             except Exception as e:
@@ -738,7 +983,7 @@ async def _on_message(message, log, is_group):
                                 break
                     if 'are video-only' in str(e):
                         params['format'] = 'bestvideo[ext=mp4]/bestvideo'
-                        ydl = youtube_dl.YoutubeDL(params=params)
+                        ydl = http_pool.install(youtube_dl.YoutubeDL(params=params))
                         try:
                             vinfo = await extract_url_info(ydl, u)
                         except Exception as e:
@@ -754,21 +999,43 @@ async def _on_message(message, log, is_group):
                     if not vinfo:
                         raise
 
+                extract_span.end()
+                # formats list is ranked again for every preferred format instead of new extraction
+                format_select.select(vinfo, pref_format)
+                ydl.params['extract_flat'] = False
+                log.debug('formats selected for ' + repr(pref_format))
                 entries = None
                 if '_type' in vinfo and (vinfo['_type'] == 'playlist' or vinfo['_type'] == 'multi_video'):
                     entries = vinfo['entries']
                 else:
                     entries = [vinfo]
 
-                for ie, entry in enumerate(entries):
+                if playlist_archive:
+                    await upload_playlist_archive(entries,
+                                                  vinfo.get('title') or str(msg_id),
+                                                  audio_mode,
+                                                  chat_id,
+                                                  msg_id,
+                                                  u,
+                                                  user_cookie,
+                                                  log,
+                                                  resolve=lambda e: resolve_playlist_entry(ydl, e, pref_format),
+                                                  first_index=params.get('playliststart', 1))
+                    return
+
+                async def process_entry(ie, entry, turn, audio_mode, cut_time_start, cut_time_end):
+                    # ie is index in entries, None result stops message processing
                     if entry is None:
+                        await turn.wait()
                         try:
                             if not is_group:
                                 await client.send_message(chat_id, f'WARN: #{params["playliststart"] + ie} was skipped due to error', reply_to=msg_id)
                         except:
                             pass
-                        continue
+                        return ENTRY_NEXT
                     formats = entry.get('requested_formats')
+                    spool_reservation = None
+                    upload_file = None
                     _file_size = None
                     chosen_format = None
                     ffmpeg_av = None
@@ -791,7 +1058,7 @@ async def _on_message(message, log, is_group):
 
                     if cmd == 's':
                         direct_url = entry.get('url') if formats is None else formats[0].get('url')
-                        if 'invidious.snopyta.org' in direct_url:
+                        if mirrors.pool.is_mirror_url(direct_url):
                             direct_url = normalize_url_path(direct_url)
 
                         await send_screenshot(chat_id,
@@ -816,23 +1083,13 @@ async def _on_message(message, log, is_group):
                                                      'http_dash_segments']:
                                     # await bot.send_message(chat_id, "ERROR: Failed find suitable format for: " + entry['title'], reply_to=msg_id)
                                     continue
-                                if 'm3u8' in f['protocol']:
-                                    _file_size = await av_utils.m3u8_video_size(f['url'], http_headers)
-                                else:
-                                    if 'filesize' in f and f['filesize'] != 0 and f['filesize'] is not None and f[
-                                        'filesize'] != 'none':
-                                        _file_size = f['filesize']
+                                try:
+                                    _file_size = await format_size(f, entry.get('duration'), http_headers)
+                                except Exception as e:
+                                    if i < len(formats) - 1 and '404 Not Found' in str(e):
+                                        break
                                     else:
-                                        try:
-                                            direct_url = f['url']
-                                            if 'invidious.snopyta.org' in direct_url:
-                                                direct_url = normalize_url_path(direct_url)
-                                            _file_size = await av_utils.media_size(direct_url, http_headers=http_headers)
-                                        except Exception as e:
-                                            if i < len(formats) - 1 and '404 Not Found' in str(e):
-                                                break
-                                            else:
-                                                raise
+                                        raise
 
                                 # Dash video
                                 if f['protocol'] == 'https' and \
@@ -843,14 +1100,10 @@ async def _on_message(message, log, is_group):
                                     vsize = 0
 
                                     direct_url = vformat['url']
-                                    if 'invidious.snopyta.org' in direct_url:
+                                    if mirrors.pool.is_mirror_url(direct_url):
                                         vformat['url'] = normalize_url_path(direct_url)
 
-                                    if 'filesize' in vformat and vformat['filesize'] != 0 and vformat[
-                                        'filesize'] is not None and vformat['filesize'] != 'none':
-                                        vsize = vformat['filesize']
-                                    else:
-                                        vsize = await av_utils.media_size(vformat['url'], http_headers=http_headers)
+                                    vsize = await format_size(vformat, entry.get('duration'), http_headers)
                                     msize = 0
                                     # if there is one more format than
                                     # it's likely an url to audio
@@ -858,29 +1111,26 @@ async def _on_message(message, log, is_group):
                                         mformat = formats[i + 1]
 
                                         direct_url = mformat['url']
-                                        if 'invidious.snopyta.org' in direct_url:
+                                        if mirrors.pool.is_mirror_url(direct_url):
                                             mformat['url'] = normalize_url_path(direct_url)
 
-                                        if 'filesize' in mformat and mformat['filesize'] != 0 and mformat[
-                                            'filesize'] is not None and mformat['filesize'] != 'none':
-                                            msize = mformat['filesize']
-                                        else:
-                                            msize = await av_utils.media_size(mformat['url'], http_headers=http_headers)
+                                        msize = await format_size(mformat, entry.get('duration'), http_headers)
                                     # we can't precisely predict media size so make it large for prevent cutting
                                     _file_size = vsize + msize + 10 * 1024 * 1024
                                     if _file_size < TG_MAX_FILE_SIZE or cut_time_start is not None or cmd == 'z':
                                         file_name = None
-                                        if not cut_time_start and STORAGE_SIZE > _file_size > 0:
-                                            STORAGE_SIZE -= _file_size
+                                        if not cut_time_start and cmd != 'z':
                                             _ext = 'mp4' if audio_mode == False else 'mp3'
-                                            file_name = str(chat_id) + ':' + str(msg_id) + ':' + entry[
-                                                'title'] + '.' + _ext
-                                        ffmpeg_av = await av_source.FFMpegAV.create(vformat,
-                                                                                    mformat,
-                                                                                    headers=http_headers,
-                                                                                    cut_time_range=_cut_time,
-                                                                                    file_name=file_name if cmd != 'z' else None,
-                                                                                    restrict_size=False if cmd == 'z' else True)
+                                            file_name = str(chat_id) + ':' + str(msg_id) + ':' + entry['title'] + '.' + _ext
+                                        ffmpeg_av, spool_reservation = await spooled_ffmpeg_av(
+                                            artifact_key(entry, audio_mode, _cut_time),
+                                            _file_size,
+                                            file_name,
+                                            vformat,
+                                            mformat,
+                                            headers=http_headers,
+                                            cut_time_range=_cut_time,
+                                            restrict_size=False if cmd == 'z' else True)
                                         chosen_format = f
                                     break
                                 # m3u8
@@ -891,12 +1141,7 @@ async def _on_message(message, log, is_group):
                                     if acodec is None or acodec == 'none':
                                         if len(formats) > i + 1:
                                             mformat = formats[i + 1]
-                                            if 'filesize' in mformat and mformat['filesize'] != 0 and mformat[
-                                                'filesize'] is not None and mformat['filesize'] != 'none':
-                                                msize = mformat['filesize']
-                                            else:
-                                                msize = await av_utils.media_size(mformat['url'],
-                                                                                  http_headers=http_headers)
+                                            msize = await format_size(mformat, entry.get('duration'), http_headers)
                                             msize += 10 * 1024 * 1024
                                             if (msize + _file_size) > TG_MAX_FILE_SIZE and cut_time_start is None and cmd != 'z':
                                                 mformat = None
@@ -904,24 +1149,26 @@ async def _on_message(message, log, is_group):
                                                 _file_size += msize
 
                                     file_name = None
-                                    if not cut_time_start and STORAGE_SIZE > _file_size > 0:
-                                        STORAGE_SIZE -= _file_size
+                                    if not cut_time_start and cmd != 'z':
                                         _ext = 'mp4' if audio_mode == False else 'mp3'
                                         file_name = str(chat_id) + ':' + str(msg_id) + ':' + entry['title'] + '.' + _ext
-                                    ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
-                                                                                aformat=mformat,
-                                                                                audio_only=True if audio_mode == True else False,
-                                                                                headers=http_headers,
-                                                                                cut_time_range=_cut_time,
-                                                                                file_name=file_name if cmd != 'z' else None,
-                                                                                restrict_size=False if cmd == 'z' else True)
+                                    ffmpeg_av, spool_reservation = await spooled_ffmpeg_av(
+                                        artifact_key(entry, audio_mode, _cut_time),
+                                        _file_size,
+                                        file_name,
+                                        chosen_format,
+                                        aformat=mformat,
+                                        audio_only=True if audio_mode == True else False,
+                                        headers=http_headers,
+                                        cut_time_range=_cut_time,
+                                        restrict_size=False if cmd == 'z' else True)
                                     break
                                 # regular video stream
                                 if (0 < _file_size <= TG_MAX_FILE_SIZE) or cut_time_start is not None or cmd == 'z':
                                     chosen_format = f
 
                                     direct_url = chosen_format['url']
-                                    if 'invidious.snopyta.org' in direct_url:
+                                    if mirrors.pool.is_mirror_url(direct_url):
                                         chosen_format['url'] = normalize_url_path(direct_url)
 
                                     if audio_mode == True and not (chosen_format['ext'] == 'mp3'):
@@ -937,26 +1184,20 @@ async def _on_message(message, log, is_group):
                                                      'http_dash_segments']:
                                 # await bot.send_message(chat_id, "ERROR: Failed find suitable format for : " + entry['title'], reply_to=msg_id)
                                 # if 'playlist' in entry and entry['playlist'] is not None:
-                                recover_playlist_index = ie
-                                break
+                                return ENTRY_RECOVER
                             if 'm3u8' in entry['protocol']:
                                 if cut_time_start is None and entry.get('is_live', False) is False and audio_mode == False:
-                                    _file_size = await av_utils.m3u8_video_size(entry['url'], http_headers=http_headers)
+                                    _file_size = await format_size(entry, entry.get('duration'), http_headers)
                                 else:
                                     # we don't know real size
                                     _file_size = 0
                             else:
-                                if 'filesize' in entry and entry['filesize'] != 0 and entry['filesize'] is not None and \
-                                        entry['filesize'] != 'none':
-                                    _file_size = entry['filesize']
-                                else:
-                                    direct_url = entry['url']
-                                    if 'invidious.snopyta.org' in direct_url:
-                                        entry['url'] = normalize_url_path(direct_url)
-                                    try:
-                                        _file_size = await av_utils.media_size(direct_url, http_headers=http_headers)
-                                    except:
-                                        _file_size = TG_MAX_FILE_SIZE
+                                if mirrors.pool.is_mirror_url(entry['url']):
+                                    entry['url'] = normalize_url_path(entry['url'])
+                                try:
+                                    _file_size = await format_size(entry, entry.get('duration'), http_headers)
+                                except:
+                                    _file_size = TG_MAX_FILE_SIZE
                             if ('m3u8' in entry['protocol'] and
                                     (_file_size <= TG_MAX_FILE_SIZE or cut_time_start is not None or cmd == 'z')):
                                 chosen_format = entry
@@ -969,20 +1210,22 @@ async def _on_message(message, log, is_group):
                                                                         time(hour=5, minute=30, second=0))
                                     _cut_time = (cut_time_start, cut_time_end)
                                 file_name = None
-                                if not cut_time_start and STORAGE_SIZE > _file_size > 0:
-                                    STORAGE_SIZE -= _file_size
+                                if not cut_time_start and cmd != 'z':
                                     _ext = 'mp4' if audio_mode == False else 'mp3'
                                     file_name = str(chat_id) + ':' + str(msg_id) + ':' + entry['title'] + '.' + _ext
-                                ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
-                                                                            audio_only=True if audio_mode == True else False,
-                                                                            headers=http_headers,
-                                                                            cut_time_range=_cut_time,
-                                                                            file_name=file_name if cmd != 'z' else None,
-                                                                            restrict_size=False if cmd == 'z' else True)
+                                ffmpeg_av, spool_reservation = await spooled_ffmpeg_av(
+                                    artifact_key(entry, audio_mode, _cut_time),
+                                    _file_size,
+                                    file_name,
+                                    chosen_format,
+                                    audio_only=True if audio_mode == True else False,
+                                    headers=http_headers,
+                                    cut_time_range=_cut_time,
+                                    restrict_size=False if cmd == 'z' else True)
                             elif (_file_size <= TG_MAX_FILE_SIZE) or cut_time_start is not None or cmd == 'z':
                                 chosen_format = entry
                                 direct_url = chosen_format['url']
-                                if 'invidious.snopyta.org' in direct_url:
+                                if mirrors.pool.is_mirror_url(direct_url):
                                     chosen_format['url'] = normalize_url_path(direct_url)
                                 if audio_mode == True and not (chosen_format['ext'] == 'mp3'):
                                     ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
@@ -992,6 +1235,7 @@ async def _on_message(message, log, is_group):
                                                                                 restrict_size=False if cmd == 'z' else True)
 
                         if chosen_format is None and ffmpeg_av is None and cmd != 'z':
+                            await turn.wait()
                             if len(preferred_formats) - 1 == ip:
                                 if _file_size > TG_MAX_FILE_SIZE:
                                     log.info('too big file ' + str(_file_size))
@@ -1010,9 +1254,9 @@ async def _on_message(message, log, is_group):
                                         source = await av_source.URLav.create(entry.get('url'), http_headers)
                                         await upload_multipart_zip(source,
                                                                    (entry['title']+'.'+entry['ext']) if user_file_name is None else user_file_name,
-                                                                   _file_size,
                                                                    chat_id,
-                                                                   msg_id)
+                                                                   msg_id,
+                                                                   raw=raw_split)
                                     else:
                                         if not is_group:
                                             await client.send_message(chat_id,
@@ -1029,9 +1273,9 @@ async def _on_message(message, log, is_group):
                                 # await bot.send_message(chat_id, "ERROR: Failed find suitable video format", reply_to=msg_id)
                                 return
                             # if 'playlist' in entry and entry['playlist'] is not None:
-                            recover_playlist_index = ie
-                            break
+                            return ENTRY_RECOVER
                         if cmd == 'z':
+                            await turn.wait()
                             if is_group:
                                 await client.send_message(chat_id,
                                                           'Command not available in chats',
@@ -1069,9 +1313,9 @@ async def _on_message(message, log, is_group):
                                 http_headers)
                             await upload_multipart_zip(upload_file,
                                                        (entry['title'] + '.' + entry['ext']) if user_file_name is None else user_file_name,
-                                                       _file_size,
                                                        chat_id,
-                                                       msg_id)
+                                                       msg_id,
+                                                       raw=raw_split)
                             return
                         if audio_mode == True and _file_size != 0 and (ffmpeg_av is None or ffmpeg_av.file_name is None):
                             # we don't know real size due to converting formats
@@ -1181,6 +1425,7 @@ async def _on_message(message, log, is_group):
 
                         # in case of video is live we don't know real duration
                         if cut_time_start is not None:
+                            await turn.wait()
                             if not entry.get('is_live') and duration > 1:
                                 if cut_time.time_to_seconds(cut_time_start) > duration:
                                     await client.send_message(chat_id,
@@ -1218,11 +1463,13 @@ async def _on_message(message, log, is_group):
                                 video_codec == 'h264' or video_codec == 'hevc') and \
                                 (audio_codec == 'mp3' or audio_codec == 'aac'):
                             file_name = str(chat_id) + ':' + str(msg_id) + ':' + entry.get('title', 'default') + '.mp4'
-                            if STORAGE_SIZE > _file_size > 0:
-                                STORAGE_SIZE -= _file_size
-                                ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
-                                                                            headers=http_headers,
-                                                                            file_name=file_name)
+                            ffmpeg_av, spool_reservation = await spooled_ffmpeg_av(
+                                artifact_key(entry, audio_mode, None) + ('m',),
+                                _file_size,
+                                file_name,
+                                chosen_format,
+                                headers=http_headers,
+                                pipe_fallback=False)
                         upload_file = ffmpeg_av if ffmpeg_av is not None else await av_source.URLav.create(
                             chosen_format['url'],
                             http_headers)
@@ -1246,37 +1493,66 @@ async def _on_message(message, log, is_group):
                             ffmpeg_cancel_task = asyncio.get_event_loop().call_later(cancel_time, ffmpeg_av.safe_close)
                         global TG_CONNECTIONS_COUNT
                         global TG_MAX_PARALLEL_CONNECTIONS
+                        upload_done = False
                         try:
                             if ffmpeg_av and ffmpeg_av.file_name:
-                                await ffmpeg_av.stream.wait()
-                                file_size_real = os.path.getsize(ffmpeg_av.file_name)
-                                STORAGE_SIZE += file_size - file_size_real
-                                file_size = file_size_real
-                                local_file = aiofiles.open(ffmpeg_av.file_name, mode='rb')
-                                upload_file = await local_file.__aenter__()
-                            # uploading piped ffmpeg file is slow anyway
-                            # TODO проверка на то что ffmpeg_av имееет file_name
-                            if (file_size > 20 * 1024 * 1024 and TG_CONNECTIONS_COUNT < TG_MAX_PARALLEL_CONNECTIONS) and \
-                                    (isinstance(upload_file, av_source.URLav) or
-                                     isinstance(upload_file, aiofiles.threadpool.binary.AsyncBufferedReader)):
-                                try:
-                                    connections = 2
-                                    if TG_CONNECTIONS_COUNT < 12 and file_size > 100 * 1024 * 1024:
-                                        connections = 4
-
-                                    TG_CONNECTIONS_COUNT += connections
-                                    file = await fast_telethon.upload_file(client,
-                                                                           upload_file,
-                                                                           file_size,
-                                                                           file_name if user_file_name is None else user_file_name,
-                                                                           max_connection=connections)
-                                finally:
-                                    TG_CONNECTIONS_COUNT -= connections
-                            else:
-                                file = await client.upload_file(upload_file,
-                                                                file_name=file_name if user_file_name is None else user_file_name,
-                                                                file_size=file_size,
-                                                                http_headers=http_headers)
+                                if ffmpeg_av.stream is not None:
+                                    await ffmpeg_av.stream.wait()
+                                spool_reservation.shrink_to_disk_size()
+                                upload_file = av_source.LocalFileAV(ffmpeg_av.file_name)
+                                file_size = upload_file.size
+                            # piped ffmpeg output has no known size, so it's uploaded in streaming mode
+                            # which picks upload mode and part count only when the pipe is drained
+                            is_stream = isinstance(upload_file, av_source.FFMpegAV)
+                            is_remote = isinstance(upload_file, av_source.URLav)
+                            if is_remote:
+                                # size could be estimated, upload needs the real one
+                                exact_size = exact_source_size(upload_file)
+                                if exact_size != 0:
+                                    file_size = exact_size
+                                else:
+                                    is_stream = True
+                            if is_stream or is_remote:
+                                # source downloads at its own speed, so slow upload doesn't idle the source connection
+                                upload_file = spill_buffer.SpillBuffer(upload_file)
+                            _thumb = None
+                            try:
+                                _thumb = await thumb.get_thumbnail(entry.get('thumbnail'), chosen_format)
+                            except Exception as e:
+                                log.warning('failed get thumbnail: ' + str(e))
+                            # next entries are prepared while this one uploads,
+                            # uploads and messages go in playlist order
+                            await turn.wait()
+                            upload_started = monotonic()
+                            with joblog.span('upload'):
+                                # stream can be uploaded only by fast_telethon, with one connection when all are busy
+                                if is_stream or (TG_CONNECTIONS_COUNT < TG_MAX_PARALLEL_CONNECTIONS and
+                                                 file_size > 20 * 1024 * 1024 and
+                                                 (is_remote or isinstance(upload_file, av_source.LocalFileAV))):
+                                    connections = 2 if TG_CONNECTIONS_COUNT < TG_MAX_PARALLEL_CONNECTIONS else 1
+                                    try:
+                                        if TG_CONNECTIONS_COUNT < 12 and file_size > 100 * 1024 * 1024 and not is_stream:
+                                            connections = 4
+
+                                        TG_CONNECTIONS_COUNT += connections
+                                        file = await fast_telethon.upload_file(client,
+                                                                               upload_file,
+                                                                               file_size if not is_stream else None,
+                                                                               file_name if user_file_name is None else user_file_name,
+                                                                               max_connection=connections)
+                                    finally:
+                                        TG_CONNECTIONS_COUNT -= connections
+                                else:
+                                    file = await client.upload_file(upload_file,
+                                                                    file_name=file_name if user_file_name is None else user_file_name,
+                                                                    file_size=file_size,
+                                                                    http_headers=http_headers)
+                            upload_done = True
+                            upload_time = monotonic() - upload_started
+                            metrics.stage_seconds.observe(upload_time, stage='upload')
+                            uploaded = upload_file.read_bytes if is_stream else file_size
+                            if upload_time > 0 and uploaded:
+                                metrics.upload_throughput.observe(uploaded / upload_time)
                         except AuthKeyDuplicatedError as e:
                             if not is_group:
                                 await client.send_message(chat_id, 'INTERNAL ERROR: try again')
@@ -1285,24 +1561,25 @@ async def _on_message(message, log, is_group):
                         except ConnectionError as e:
                             if 'Cannot send requests while disconnected' in str(e):
                                 await client.connect()
-                                continue
+                                return ENTRY_NEXT
                             raise
                         finally:
                             if ffmpeg_av and ffmpeg_av.file_name:
-                                STORAGE_SIZE += file_size
-                                if STORAGE_SIZE > MAX_STORAGE_SIZE:
-                                    log.warning('logic error, reclaimed storage size bigger then initial')
-                                    STORAGE_SIZE = MAX_STORAGE_SIZE
-                                if isinstance(upload_file, aiofiles.threadpool.binary.AsyncBufferedReader):
-                                    await local_file.__aexit__(exc_type=None, exc_val=None, exc_tb=None)
                                 try:
-                                    os.remove(ffmpeg_av.file_name)
+                                    if upload_done:
+                                        # keep remuxed file for retries and repeated requests
+                                        spool.cache.put(spool_reservation, ffmpeg_av.format)
+                                        log.debug('spool cache stats: ' + str(spool.cache.stats()))
+                                    else:
+                                        spool_reservation.release()
                                 except Exception as e:
                                     log.exception(e)
 
                             if ffmpeg_cancel_task is not None and not ffmpeg_cancel_task.cancelled():
                                 ffmpeg_cancel_task.cancel()
 
+                            if isinstance(upload_file, spill_buffer.SpillBuffer):
+                                log.debug('source buffer stats: ' + str(upload_file.stats()))
                             if upload_file is not None:
                                 if inspect.iscoroutinefunction(upload_file.close):
                                     await upload_file.close()
@@ -1348,25 +1625,21 @@ async def _on_message(message, log, is_group):
                             else:
                                 link = f'https://t.me/{chat_username}/{msg_id}'
                             caption = '['+caption+']' + f'({link})'
-                        recover_playlist_index = None
-                        _thumb = None
-                        try:
-                            _thumb = await thumb.get_thumbnail(entry.get('thumbnail'), chosen_format)
-                        except Exception as e:
-                            log.warning('failed get thumbnail: ' + str(e))
-
                         for i in range(3):
                             try:
-                                await client.send_file(chat_id, file,
-                                                       video_note=video_note,
-                                                       voice_note=voice_note,
-                                                       attributes=attributes,
-                                                       caption=caption,
-                                                       force_document=force_document,
-                                                       supports_streaming=False if ffmpeg_av is not None else True,
-                                                       thumb=_thumb,
-                                                       reply_to=msg_id if not is_group or user.settings.get('force_reply', 0) else None,
-                                                       silent=True if is_group else False)
+                                send_started = monotonic()
+                                with joblog.span('send_file'):
+                                    await client.send_file(chat_id, file,
+                                                           video_note=video_note,
+                                                           voice_note=voice_note,
+                                                           attributes=attributes,
+                                                           caption=caption,
+                                                           force_document=force_document,
+                                                           supports_streaming=False if ffmpeg_av is not None else True,
+                                                           thumb=_thumb,
+                                                           reply_to=msg_id if not is_group or user.settings.get('force_reply', 0) else None,
+                                                           silent=True if is_group else False)
+                                metrics.stage_seconds.observe(monotonic() - send_started, stage='send_file')
                             except AuthKeyDuplicatedError as e:
                                 if not is_group:
                                     await client.send_message(chat_id, 'INTERNAL ERROR: try again')
@@ -1391,10 +1664,77 @@ async def _on_message(message, log, is_group):
                             raise
                         else:
                             log.warning(e)
-                            recover_playlist_index = ie
+                            return ENTRY_FAILED
+                    finally:
+                        if spool_reservation is not None:
+                            spool_reservation.release()
+                        if upload_file is None and ffmpeg_av is not None:
+                            # stopped before upload, e.g. pipeline was cancelled
+                            ffmpeg_av.safe_close()
+                    return ENTRY_SENT
+
+                # entries are processed concurrently in order of playlist, few ahead of the uploading one
+                prefetch = PLAYLIST_PREFETCH if playlist_start is not None else 0
+                indexes = list(range(len(entries))) if retry_entries is None else retry_entries
+                retry_entries = None
+                failed_entries = []
+                entries_iter = iter_playlist_entries(ydl, entries, pref_format, resolved_entries, indexes).__aiter__()
+                turns = []
+                tasks = []
+
+                async def traced_entry(ie, *args):
+                    # entry task has its own copy of job context, so spans of concurrent entries don't mix
+                    with joblog.span('entry' + str(ie)):
+                        return await process_entry(ie, *args)
+
+                async def start_next():
+                    # waits for extraction of the next entry, False if there are no more entries
+                    try:
+                        ie, entry = await entries_iter.__anext__()
+                    except StopAsyncIteration:
+                        return False
+                    turns.append(asyncio.Event())
+                    tasks.append(asyncio.get_event_loop().create_task(
+                        traced_entry(ie, entry, turns[-1], audio_mode, cut_time_start, cut_time_end)))
+                    return True
 
-                if recover_playlist_index is None:
+                try:
+                    it = 0
+                    while it < len(tasks) or await start_next():
+                        turns[it].set()
+                        # next entries are extracted while this one is processed
+                        while len(tasks) <= it + prefetch and await start_next():
+                            pass
+                        result = await tasks[it]
+                        if result is None:
+                            return
+                        if result == ENTRY_RECOVER:
+                            # no suitable format, this entry and the rest go with the next format
+                            retry_entries = failed_entries + indexes[it:]
+                            break
+                        if result == ENTRY_FAILED:
+                            failed_entries.append(indexes[it])
+                        it += 1
+                finally:
+                    await entries_iter.aclose()
+                    pending = [t for t in tasks if not t.done()]
+                    for task in pending:
+                        task.cancel()
+                    if len(pending) != 0:
+                        await asyncio.gather(*pending, return_exceptions=True)
+
+                if retry_entries is None and len(failed_entries) != 0:
+                    # failed entries are tried again when the others are sent
+                    retry_entries = failed_entries
+                if retry_entries is None:
                     break
+            else:
+                if retry_entries and 'playliststart' in params and not is_group:
+                    await client.send_message(chat_id,
+                                              'WARN: ' + ', '.join('#' + str(params['playliststart'] + i)
+                                                                   for i in retry_entries) +
+                                              ' was skipped due to error',
+                                              reply_to=msg_id)
     finally:
         if not is_group or user.settings.get('nonprivate_action', 0):
             await action.__aexit__()
@@ -1410,30 +1750,47 @@ api_hash = "eb06d4abfb49dc3eeb1aeb98ae0f581e"
 # YTDL_LAMBDA_URL = os.environ['YTDL_LAMBDA_URL']
 # YTDL_LAMBDA_SECRET = os.environ['YTDL_LAMBDA_SECRET']
 
-client = TelegramClient("bot", api_id, api_hash).start(bot_token=os.environ['BOT_TOKEN'])
+# started by startup()
+client = TelegramClient("bot", api_id, api_hash)
+
+# imported by startup() in background, the import takes a while
+youtube_dl = None
+TikTokIE = None
+PinterestIE = None
 
-vid_format = '((best[ext=mp4,height<=1080]+best[ext=mp4,height<=480])[protocol^=http]/best[ext=mp4,height<=1080]+best[ext=mp4,height<=480]/best[ext=mp4]+worst[ext=mp4]/best[ext=mp4]/(bestvideo[ext=mp4,height<=1080]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]))[protocol^=http]/bestvideo[ext=mp4]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4])/best)[protocol!=http_dash_segments]'
-vid_fhd_format = '((best[ext=mp4][height<=1080][height>720])[protocol^=http]/best[ext=mp4][height<=1080][height>720]/  (bestvideo[ext=mp4][height<=1080][height>720]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=1080][height>720])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=1080][height>720]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/  (best[ext=mp4][height<=720][height>360])[protocol^=http]/best[ext=mp4][height<=720][height>360]/  (bestvideo[ext=mp4][height<=720][height>360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=720][height>360])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=720][height>360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio) /  (best[ext=mp4][height<=360])[protocol^=http]/best[ext=mp4][height<=360]/  (bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=360])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/   best[ext=mp4]   /bestvideo[ext=mp4]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/best)[protocol!=http_dash_segments][vcodec !^=? av01]'
-vid_hd_format = '((best[ext=mp4][height<=720][height>360])[protocol^=http]/best[ext=mp4][height<=720][height>360]/  (bestvideo[ext=mp4][height<=720][height>360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=720][height>360])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=720][height>360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio) /  (best[ext=mp4][height<=360])[protocol^=http]/best[ext=mp4][height<=360]/  (bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=360])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/   best[ext=mp4]   /bestvideo[ext=mp4]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/best)[protocol!=http_dash_segments][vcodec !^=? av01]'
-vid_nhd_format = '((best[ext=mp4][height<=360])[protocol^=http]/best[ext=mp4][height<=360]/  (bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=360])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/   best[ext=mp4]   /bestvideo[ext=mp4]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/best)[protocol!=http_dash_segments][vcodec !^=? av01]'
+vid_fhd_format = format_select.FormatSpec(1080)
+vid_hd_format = format_select.FormatSpec(720)
+vid_nhd_format = format_select.FormatSpec(360)
 worst_video_format = vid_nhd_format
-audio_format = '((bestaudio[ext=m4a]/bestaudio[ext=mp3])[protocol^=http]/bestaudio/best[ext=mp4,height<=480]/best[ext=mp4]/best)[protocol!=http_dash_segments]'
+audio_format = format_select.FormatSpec(audio=True)
 
 url_extractor = URLExtract()
 
 playlist_range_re = re.compile('([0-9]+)-([0-9]+)')
-playlist_cmds = ['p', 'pa', 'pw']
-available_cmds = ['start', 'ping', 'donate', 'settings', 'a', 'w', 'c', 's', 't', 'm', 'z'] + playlist_cmds
+playlist_cmds = ['p', 'pa', 'pw', 'pz', 'paz', 'pwz']
+available_cmds = ['start', 'ping', 'donate', 'settings', 'a', 'w', 'c', 's', 't', 'm', 'z', 'zr'] + playlist_cmds
 
 TG_MAX_FILE_SIZE = 2000 * 1024 * 1024
+# playlist entries downloaded in background while archiving
+PLAYLIST_ARCHIVE_PREFETCH = int(os.getenv('PLAYLIST_ARCHIVE_PREFETCH', 2))
+# playlist entries prepared while the current one uploads
+PLAYLIST_PREFETCH = int(os.getenv('PLAYLIST_PREFETCH', 2))
+# results of playlist entry processing
+ENTRY_SENT = 'sent'
+ENTRY_NEXT = 'next'
+ENTRY_FAILED = 'failed'
+ENTRY_RECOVER = 'recover'
 TG_MAX_PARALLEL_CONNECTIONS = 20
 TG_CONNECTIONS_COUNT = 0
-MAX_STORAGE_SIZE = int(os.getenv('STORAGE_SIZE', 0)) * 1024 * 1024
-STORAGE_SIZE = MAX_STORAGE_SIZE
-YT_TOO_MANY_REQUEST = False
 
 async def shutdown():
+    try:
+        # writer retries until the store is back, it's not waited for forever
+        await asyncio.wait_for(users.settings_writer.flush(), 30)
+    except asyncio.TimeoutError:
+        joblog.log.error('settings writes are not finished before shutdown')
     await tg_client_shutdown()
+    joblog.handler.flush()
     sys.exit(1)
 
 
@@ -1445,14 +1802,95 @@ def sig_handler():
     asyncio.run_coroutine_threadsafe(shutdown(), asyncio.get_event_loop())
 
 
+def import_youtube_dl():
+    global youtube_dl, TikTokIE, PinterestIE
+    import youtube_dl as ytdl
+    from extractor.tiktok import TikTokIE as tiktok_ie
+    from extractor.pinterest import PinterestIE as pinterest_ie
+    youtube_dl, TikTokIE, PinterestIE = ytdl, tiktok_ie, pinterest_ie
+    extractor_router.router.build(youtube_dl.extractor.gen_extractor_classes(), [TikTokIE, PinterestIE])
+    print('Extractor router: ', extractor_router.router.stats())
+
+
+def prepare_spool():
+    print('Allowed storage size: ', spool.MAX_STORAGE_SIZE, 'in', spool.SPOOL_DIR)
+    print('Removed orphaned spool files: ', spool.manager.cleanup_orphans())
+    if os.path.abspath(spool.SPOOL_DIR) != os.getcwd():
+        print('Removed orphaned remux files of working directory: ', spool.manager.cleanup_orphans(os.getcwd()))
+    print('Loaded spool cache entries: ', spool.cache.load())
+
+
+startup_done = asyncio.Event()
+# seconds spent in each startup phase
+startup_timings = {}
+QUEUED_UPDATES = 0
+
+
+async def timed_phase(name, coro):
+    started = monotonic()
+    await coro
+    startup_timings[name] = monotonic() - started
+    print('Startup phase {} took {:.3f}s'.format(name, startup_timings[name]))
+
+
+async def on_metrics(request):
+    return web.Response(body=metrics.render().encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+# stats of components are collected only when metrics are scraped
+metrics.register(metrics.Gauge('telegram_connections', 'Telegram upload connections in use',
+                               func=lambda: TG_CONNECTIONS_COUNT))
+metrics.register(metrics.Gauge('queued_updates', 'Updates received before startup finished',
+                               func=lambda: QUEUED_UPDATES))
+metrics.register(metrics.Stats('startup', lambda: {p: {'seconds': t} for p, t in startup_timings.items()},
+                               label='phase'))
+metrics.register(metrics.Stats('executor', executors.stats, label='executor',
+                               counters=('completed', 'wait_time', 'busy_time')))
+metrics.register(metrics.Stats('spool_bytes', spool.manager.stats))
+if spool.spill_manager is not spool.manager:
+    metrics.register(metrics.Stats('spill_bytes', spool.spill_manager.stats))
+metrics.register(metrics.Stats('spool_cache', spool.cache.stats, counters=('hits', 'misses', 'evictions')))
+metrics.register(metrics.Stats('settings_cache', users.settings_cache.stats, counters=('hits', 'misses')))
+metrics.register(metrics.Stats('settings_writer', users.settings_writer.stats,
+                               counters=('changes', 'writes', 'docs_written', 'conflicts', 'requeued')))
+metrics.register(metrics.Stats('user_lookups', users.lookup_batcher.stats, counters=('lookups', 'requests')))
+metrics.register(metrics.Stats('extractor_router', extractor_router.router.stats,
+                               counters=('resolved', 'routed', 'resolve_time')))
+metrics.register(metrics.Stats('http_pool', http_pool.default_pool.stats,
+                               counters=('created', 'reused', 'expired', 'retried')))
+metrics.register(metrics.Stats('route', mirrors.pool.stats, label='route', counters=('successes', 'failures', 'opens')))
+metrics.register(metrics.Stats('log', joblog.handler.stats, counters=('written', 'dropped')))
+metrics.register(metrics.Stats('loop', loop_monitor.monitor.stats, counters=('stalls',)))
+
+
+async def start_webhook(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=int(os.getenv('PORT', 8080))).start()
+
+
+async def startup():
+    started = monotonic()
+    await asyncio.gather(timed_phase('telegram', client.start(bot_token=os.environ['BOT_TOKEN'])),
+                         timed_phase('db', users.connect()),
+                         timed_phase('youtube_dl', executors.extraction.run(import_youtube_dl)),
+                         timed_phase('spool', executors.file_io.run(prepare_spool)))
+    startup_done.set()
+    print('Startup finished in {:.3f}s, {} queued updates'.format(monotonic() - started, QUEUED_UPDATES))
+
+
 if __name__ == '__main__':
-    print('Allowed storage size: ', STORAGE_SIZE)
     app = web.Application()
-    app.add_routes([web.post('/bot', on_message)])
+    app.add_routes([web.post('/bot', on_message),
+                    web.get('/metrics', on_metrics)])
     # asyncio.get_event_loop().create_task(bot._run_until_disconnected())
     asyncio.get_event_loop().add_signal_handler(signal.SIGABRT, sig_handler)
     asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, sig_handler)
     asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, sig_handler)
     app.on_shutdown.append(tg_client_shutdown)
-    asyncio.get_event_loop().create_task(web.run_app(app))
+    # reports callbacks which block the loop, e.g. sync file or cpu work not moved to executors
+    loop_monitor.monitor.start(asyncio.get_event_loop())
+    asyncio.get_event_loop().run_until_complete(timed_phase('webhook', start_webhook(app)))
+    asyncio.get_event_loop().run_until_complete(startup())
     client.run_until_disconnected()
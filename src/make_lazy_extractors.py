@@ -0,0 +1,135 @@
+"""
+Generates youtube_dl/extractor/lazy_extractors.py like youtube-dl "make lazy-extractors" does,
+pip releases don't include it so importing youtube_dl loads all extractor modules.
+With the file extractor classes are stubs with _VALID_URL and suitable(),
+the real module is imported only when extractor is instantiated.
+Must be run again after every youtube-dl update.
+"""
+import importlib.util
+import os
+import sys
+from inspect import getsource
+
+LAZY_BASE = '''# flake8: noqa
+from __future__ import unicode_literals
+
+import re
+
+
+class LazyLoadExtractor(object):
+    _module = None
+
+    @classmethod
+    def ie_key(cls):
+        return cls.__name__[:-2]
+
+    def __new__(cls, *args, **kwargs):
+        mod = __import__(cls._module, fromlist=(cls.__name__,))
+        real_cls = getattr(mod, cls.__name__)
+        instance = real_cls.__new__(real_cls)
+        instance.__init__(*args, **kwargs)
+        return instance
+'''
+
+IE_TEMPLATE = '''
+
+class {name}({bases}):
+    _VALID_URL = {valid_url!r}
+    _module = '{module}'
+'''
+
+MAKE_VALID_TEMPLATE = '''
+    @classmethod
+    def _make_valid_url(cls):
+        return {valid_url!r}
+'''
+
+
+def lazy_extractors_path():
+    spec = importlib.util.find_spec('youtube_dl')
+    if spec is None:
+        raise Exception('youtube_dl is not installed')
+    return os.path.join(os.path.dirname(spec.origin), 'extractor', 'lazy_extractors.py')
+
+
+def remove(path):
+    for p in [path, path + 'c']:
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+
+def generate():
+    from youtube_dl.extractor import _ALL_CLASSES, _LAZY_LOADER
+    from youtube_dl.extractor.common import InfoExtractor, SearchInfoExtractor
+    if _LAZY_LOADER:
+        raise Exception('youtube_dl is loaded with lazy extractors already')
+
+    def base_name(base):
+        if base is InfoExtractor:
+            return 'LazyLoadExtractor'
+        elif base is SearchInfoExtractor:
+            return 'LazyLoadSearchExtractor'
+        return base.__name__
+
+    def build(ie):
+        s = IE_TEMPLATE.format(name=ie.__name__,
+                               bases=', '.join(map(base_name, ie.__bases__)),
+                               valid_url=getattr(ie, '_VALID_URL', None),
+                               module=ie.__module__)
+        if ie.suitable.__func__ is not InfoExtractor.suitable.__func__:
+            s += '\n' + getsource(ie.suitable)
+        if hasattr(ie, '_make_valid_url'):
+            # search extractors
+            s += MAKE_VALID_TEMPLATE.format(valid_url=ie._make_valid_url())
+        return s
+
+    # parents are defined before children, generic extractor is the last one
+    generic = _ALL_CLASSES[-1]
+    classes = list(_ALL_CLASSES[:-1])
+    ordered = []
+    while classes:
+        for c in classes[:]:
+            bases = set(c.__bases__) - {object, InfoExtractor, SearchInfoExtractor}
+            missing = [b for b in bases if b not in classes and b not in ordered]
+            if missing:
+                classes[0:0] = missing
+                break
+            if all(b in ordered for b in bases):
+                ordered.append(c)
+                classes.remove(c)
+                break
+    ordered.append(generic)
+
+    contents = [LAZY_BASE + '\n' + getsource(InfoExtractor.suitable),
+                '\n\nclass LazyLoadSearchExtractor(LazyLoadExtractor):\n    pass\n']
+    all_classes = set(_ALL_CLASSES)
+    names = []
+    for ie in ordered:
+        contents.append(build(ie))
+        if ie in all_classes:
+            names.append(ie.__name__)
+    contents.append('\n\n_ALL_CLASSES = [{}]\n'.format(', '.join(names)))
+    return ''.join(contents)
+
+
+def main():
+    path = lazy_extractors_path()
+    # stale file would make youtube_dl import old stubs instead of real extractors
+    remove(path)
+    source = generate()
+    compile(source, path, 'exec')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(source)
+    os.replace(tmp_path, path)
+    print('Generated lazy extractors: ' + path)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print('Failed generate lazy extractors: ' + str(e))
+        sys.exit(1)
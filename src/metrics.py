@@ -0,0 +1,191 @@
+import bisect
+import time
+
+PREFIX = 'ytbdownbot_'
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+# bytes per second
+THROUGHPUT_BUCKETS = tuple(mb * 1024 * 1024 for mb in (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if value == float('inf'):
+        return '+Inf'
+    if value != value:
+        return 'NaN'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Metric family in Prometheus text format, values are changed only from the event loop thread
+    so there is no locking on the hot path.
+    """
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(labels[l] for l in self.labels)
+
+    def samples(self):
+        # (name suffix, [(label, value)], value)
+        for key, value in self.values.items():
+            yield '', list(zip(self.labels, key)), value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+        for suffix, labels, value in self.samples():
+            lines.append(self.name + suffix + _format_labels(labels) + ' ' + _format_value(value))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), func=None):
+        # func is called on scrape for value taken from somewhere else
+        super().__init__(name, help, labels)
+        self.func = func
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.func is not None:
+            yield '', [], self.func()
+            return
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        h = self.values.get(key)
+        if h is None:
+            # counts per bucket, sum, count
+            h = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        h[0][bisect.bisect_left(self.buckets, value)] += 1
+        h[1] += value
+        h[2] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float('inf'),), counts):
+                cumulative += c
+                yield '_bucket', labels + [('le', _format_value(float(bound)))], cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, count
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.monotonic() - self.started, **self.labels)
+
+
+class Stats(Metric):
+    """
+    Exports stats() dict of a component as gauges and counters, counters get _total suffix,
+    dict of dicts is exported with the outer key as label.
+    """
+
+    def __init__(self, name, func, label=None, counters=()):
+        super().__init__(name, name + ' stats')
+        self.func = func
+        self.label = label
+        self.counters = set(counters)
+
+    def render(self):
+        stats = self.func()
+        rows = stats.items() if self.label is not None else [(None, stats)]
+        families = {}
+        for label_value, row in rows:
+            for key, value in row.items():
+                if isinstance(value, (int, float)):
+                    labels = [(self.label, label_value)] if self.label is not None else []
+                    families.setdefault(key, []).append((labels, value))
+        lines = []
+        for key, samples in families.items():
+            counter = key in self.counters
+            name = self.name + '_' + key + ('_total' if counter else '')
+            lines.append('# TYPE {} {}'.format(name, 'counter' if counter else 'gauge'))
+            for labels, value in samples:
+                lines.append(name + _format_labels(labels) + ' ' + _format_value(value))
+        return '\n'.join(lines)
+
+
+registry = []
+
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+
+def render():
+    parts = []
+    for metric in registry:
+        try:
+            parts.append(metric.render())
+        except Exception as e:
+            # broken collector shouldn't hide the others
+            print('Failed render metric ' + metric.name + ': ' + str(e))
+    return '\n'.join(p for p in parts if p) + '\n'
+
+
+stage_seconds = register(Histogram('stage_seconds', 'Duration of media processing stages', ['stage']))
+upload_throughput = register(Histogram('upload_bytes_per_second', 'Telegram upload speed',
+                                       buckets=THROUGHPUT_BUCKETS))
+errors = register(Counter('errors_total', 'Failed messages by exception type', ['type']))
+active_jobs = register(Gauge('active_jobs', 'Messages being processed'))
+ffmpeg_processes = register(Gauge('ffmpeg_processes', 'Running ffmpeg processes'))
+active_jobs.set(0)
+ffmpeg_processes.set(0)
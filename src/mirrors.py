@@ -0,0 +1,137 @@
+import os
+import re
+import time
+from urllib.parse import urlparse
+
+# invidious instances used when youtube blocks the bot, first one is tried first until there is latency data
+INVIDIOUS_MIRRORS = [h.strip() for h in os.getenv('INVIDIOUS_MIRRORS', 'invidious.snopyta.org').split(',') if h.strip()]
+# seconds before an open route lets a trial request through
+ROUTE_COOLDOWN = int(os.getenv('ROUTE_COOLDOWN', 600))
+# consecutive failures that open a mirror, youtube is opened by the first 429
+MIRROR_FAILURE_THRESHOLD = int(os.getenv('MIRROR_FAILURE_THRESHOLD', 3))
+# weight of the last request in the moving averages
+EWMA_ALPHA = 0.3
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class Route:
+    """
+    Circuit breaker with latency and error rate of a backend.
+    Open route is skipped until cooldown is over, then one trial request decides if it's closed again.
+    """
+
+    def __init__(self, host, failure_threshold=1, cooldown=ROUTE_COOLDOWN):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.trial_at = 0.0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.error_rate = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.opens = 0
+
+    def available(self):
+        # only checks, request that is really sent takes the trial with acquire_trial
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN:
+            return now - self.opened_at >= self.cooldown
+        # trial request that never reported back doesn't block the route forever
+        return now - self.trial_at >= self.cooldown
+
+    def acquire_trial(self):
+        # called before sending request, False if the route is open or other request has the trial
+        if self.state == CLOSED:
+            return True
+        if not self.available():
+            return False
+        self.state = HALF_OPEN
+        self.trial_at = time.monotonic()
+        return True
+
+    def _open(self):
+        if self.state != OPEN:
+            self.opens += 1
+            print('route ' + self.host + ' is open for ' + str(self.cooldown) + 's')
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+
+    def success(self, latency=None):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.error_rate *= 1 - EWMA_ALPHA
+        if latency is not None:
+            self.latency = latency if self.latency is None else \
+                EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency
+        if self.state != CLOSED:
+            print('route ' + self.host + ' is closed')
+        self.state = CLOSED
+
+    def failure(self, trip=False):
+        # trip opens the route at once, e.g. on 429
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.error_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.error_rate
+        if trip or self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self._open()
+
+    def score(self):
+        # lower is better, routes without data go first to get some
+        if self.latency is None:
+            return 0.0
+        return self.latency * (1 + 4 * self.error_rate)
+
+    def stats(self):
+        return {'state': self.state, 'closed': self.state == CLOSED,
+                'latency': round(self.latency, 3) if self.latency is not None else None,
+                'error_rate': round(self.error_rate, 3), 'successes': self.successes,
+                'failures': self.failures, 'opens': self.opens}
+
+
+class MirrorPool:
+    """
+    Youtube itself and its invidious mirrors, picks the fastest healthy mirror for fallbacks.
+    """
+
+    def __init__(self, hosts):
+        self.youtube = Route('youtube.com')
+        self.mirrors = [Route(h, failure_threshold=MIRROR_FAILURE_THRESHOLD) for h in hosts]
+        self.watch_re = re.compile(r'https?://(?:www\.)?(?:' + '|'.join(re.escape(h) for h in hosts) +
+                                   r')/watch\?v=(?P<id>[0-9A-Za-z_-]{11})')
+
+    def ranked(self):
+        return sorted([m for m in self.mirrors if m.available()], key=Route.score)
+
+    def best(self):
+        # None if all mirrors are open
+        ranked = self.ranked()
+        return ranked[0] if len(ranked) != 0 else None
+
+    def mirror_for(self, url):
+        host = (urlparse(url).hostname or '').lower()
+        if host.startswith('www.'):
+            host = host[4:]
+        for m in self.mirrors:
+            if m.host == host:
+                return m
+        return None
+
+    def is_mirror_url(self, url):
+        return self.mirror_for(url) is not None
+
+    def stats(self):
+        stats = {self.youtube.host: self.youtube.stats()}
+        for m in self.mirrors:
+            stats[m.host] = m.stats()
+        return stats
+
+
+pool = MirrorPool(INVIDIOUS_MIRRORS)
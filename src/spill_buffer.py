@@ -0,0 +1,236 @@
+import asyncio
+import collections
+import inspect
+import os
+import tempfile
+import time
+import av_source
+import executors
+import spool
+
+
+# sizes in MB like STORAGE_SIZE
+SPILL_MEMORY_SIZE = int(os.getenv('SPILL_MEMORY_SIZE', 16)) * 1024 * 1024
+SPILL_HIGH_WATERMARK = int(os.getenv('SPILL_HIGH_WATERMARK', 512)) * 1024 * 1024
+SPILL_LOW_WATERMARK = int(os.getenv('SPILL_LOW_WATERMARK', 256)) * 1024 * 1024
+READ_CHUNK_SIZE = 512 * 1024
+# spill file space is reserved from spool manager by this much at once
+SPILL_RESERVE_STEP = 32 * 1024 * 1024
+
+
+_spill_disabled_warned = False
+
+
+def _warn_spill_disabled():
+    global _spill_disabled_warned
+    if not _spill_disabled_warned:
+        _spill_disabled_warned = True
+        print('Spill to disk is disabled, set STORAGE_SIZE or SPILL_STORAGE_SIZE, '
+              'sources are buffered only in memory up to', SPILL_MEMORY_SIZE)
+
+
+class SpillBuffer(av_source.DumbReader):
+    """
+    Reads the source in background task at its own speed and keeps
+    not yet consumed data in memory, overflowing to temp file on spool disk.
+    Source reading is paused when buffered data reach high watermark
+    and resumed when it drops below low watermark.
+    Spill file is counted in spool manager, when there is no free space left
+    reading waits for the consumer instead of spilling more.
+    """
+
+    def __init__(self, source,
+                 memory_size=SPILL_MEMORY_SIZE,
+                 high_watermark=SPILL_HIGH_WATERMARK,
+                 low_watermark=SPILL_LOW_WATERMARK,
+                 spool_dir=spool.SPOOL_DIR,
+                 manager=spool.spill_manager):
+        self.source = source
+        self.memory_size = memory_size
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.spool_dir = spool_dir
+        self.manager = manager
+        self._reservation = None
+        self._buf = b''
+        self._mem = collections.deque()
+        self._mem_size = 0
+        self._disk = None
+        self._disk_lock = asyncio.Lock()
+        self._disk_write_pos = 0
+        self._disk_read_pos = 0
+        self._eof = False
+        self._error = None
+        self._closed = False
+        self._data_event = asyncio.Event()
+        self._space_event = asyncio.Event()
+        # seconds source reading was paused because consumer is slow
+        self.producer_stall = 0.0
+        # seconds consumer waited for the source
+        self.consumer_stall = 0.0
+        self.read_bytes = 0
+        self.spilled_bytes = 0
+        # times reading waited because spool disk was full
+        self.spill_waits = 0
+        self._producer = asyncio.get_event_loop().create_task(self._produce())
+
+    @property
+    def buffered(self):
+        return self._mem_size + self._disk_write_pos - self._disk_read_pos
+
+    def stats(self):
+        return {'read_bytes': self.read_bytes,
+                'spilled_bytes': self.spilled_bytes,
+                'spill_reserved': self._reservation.size if self._reservation is not None else 0,
+                'spill_waits': self.spill_waits,
+                'producer_stall': round(self.producer_stall, 3),
+                'consumer_stall': round(self.consumer_stall, 3)}
+
+    async def _produce(self):
+        try:
+            while True:
+                if self.buffered >= self.high_watermark:
+                    started = time.monotonic()
+                    while self.buffered > self.low_watermark:
+                        self._space_event.clear()
+                        await self._space_event.wait()
+                    self.producer_stall += time.monotonic() - started
+                data = await self.source.read(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                self.read_bytes += len(data)
+                await self._push(data)
+                self._data_event.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._error = e
+        finally:
+            self._eof = True
+            self._data_event.set()
+
+    def _reserve_disk(self, end):
+        # spill file is never truncated, so it takes as much space as its furthest write
+        reserved = self._reservation.size if self._reservation is not None else 0
+        if end <= reserved:
+            return True
+        step = max(SPILL_RESERVE_STEP, end - reserved)
+        if self.manager.capacity == 0:
+            _warn_spill_disabled()
+            return False
+        if self._reservation is None:
+            self._reservation = self.manager.reserve(step, 'spill-' + str(id(self)))
+            return self._reservation is not None
+        return self._reservation.grow(step)
+
+    async def _push(self, data):
+        started = None
+        while True:
+            # data goes to disk while there is unread data on it to keep the order
+            if self._disk_write_pos == self._disk_read_pos and self._mem_size + len(data) <= self.memory_size:
+                self._mem.append(data)
+                self._mem_size += len(data)
+                break
+            write_pos = self._disk_write_pos if self._disk_write_pos != self._disk_read_pos else 0
+            if self._reserve_disk(write_pos + len(data)):
+                await self._spill(data)
+                break
+            # spool disk is full, wait until consumer frees memory or reads the spill file to the end
+            if started is None:
+                started = time.monotonic()
+                self.spill_waits += 1
+            self._space_event.clear()
+            await self._space_event.wait()
+        if started is not None:
+            self.producer_stall += time.monotonic() - started
+
+    async def _spill(self, data):
+        async with self._disk_lock:
+            if self._disk is None:
+                self._disk = await executors.file_io.run(tempfile.TemporaryFile, 'w+b', -1, None, None,
+                                                         'spill', 'spill', self.spool_dir)
+            elif self._disk_write_pos == self._disk_read_pos:
+                # everything was consumed, start over from the file beginning
+                self._disk_write_pos = self._disk_read_pos = 0
+            await executors.file_io.run(os.pwrite, self._disk.fileno(), data, self._disk_write_pos)
+            self._disk_write_pos += len(data)
+            self.spilled_bytes += len(data)
+
+    def _pop_memory(self):
+        if len(self._mem) == 0:
+            return None
+        data = self._mem.popleft()
+        self._mem_size -= len(data)
+        return data
+
+    async def _pop_disk(self):
+        async with self._disk_lock:
+            unread = self._disk_write_pos - self._disk_read_pos
+            if unread <= 0:
+                return None
+            data = await executors.file_io.run(os.pread,
+                                               self._disk.fileno(),
+                                               min(unread, 4 * READ_CHUNK_SIZE),
+                                               self._disk_read_pos)
+            self._disk_read_pos += len(data)
+            return data
+
+    async def read(self, n: int = -1):
+        buf = bytearray(self._buf)
+        self._buf = b''
+        while n == -1 or len(buf) < n:
+            data = self._pop_memory()
+            if data is None and self._disk_write_pos > self._disk_read_pos:
+                data = await self._pop_disk()
+            if data is None:
+                if len(self._mem) != 0 or self._disk_write_pos > self._disk_read_pos:
+                    continue
+                if self._eof:
+                    break
+                self._data_event.clear()
+                started = time.monotonic()
+                await self._data_event.wait()
+                self.consumer_stall += time.monotonic() - started
+                continue
+            buf.extend(data)
+            self._space_event.set()
+
+        if len(buf) == 0 and self._error is not None:
+            raise self._error
+        if n != -1 and len(buf) > n:
+            self._buf = bytes(buf[n:])
+            del buf[n:]
+        return bytes(buf)
+
+    async def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if not self._producer.done():
+            self._producer.cancel()
+            try:
+                await self._producer
+            except asyncio.CancelledError:
+                pass
+        if inspect.iscoroutinefunction(self.source.close):
+            await self.source.close()
+        else:
+            self.source.close()
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+        if self._reservation is not None:
+            self._reservation.release()
+            self._reservation = None
+        self._mem.clear()
+        self._mem_size = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        b = await self.read(512 * 1024)
+        if len(b) == 0:
+            raise StopAsyncIteration()
+        else:
+            return b
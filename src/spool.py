@@ -0,0 +1,286 @@
+import os
+import re
+import tempfile
+import hashlib
+from collections import OrderedDict
+
+
+# directory for local remux files and spilled buffers, better to point it to tmpfs or fast SSD,
+# orphaned files are removed from it on startup so it shouldn't be shared
+SPOOL_DIR = os.getenv('SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'ytbdownbot-spool'))
+MAX_STORAGE_SIZE = int(os.getenv('STORAGE_SIZE', 0)) * 1024 * 1024
+# spill files of source buffers share STORAGE_SIZE when it's set, otherwise they get own budget
+SPILL_STORAGE_SIZE = int(os.getenv('SPILL_STORAGE_SIZE', 1024)) * 1024 * 1024
+# finished remux files are kept for reuse up to this size, cache gives space back to new reservations anyway
+MAX_CACHE_SIZE = int(os.getenv('CACHE_SIZE', MAX_STORAGE_SIZE // (1024 * 1024))) * 1024 * 1024
+
+# remux files are named like "chat_id:msg_id:title.ext", optionally quoted by av_source.FFMpegAV
+spool_file_re = re.compile(r"^'?-?[0-9]+:[0-9]+:")
+cache_file_re = re.compile(r'^cache-(?P<digest>[0-9a-f]{40})\.(?P<format>[0-9a-z]+)$')
+
+
+def file_disk_size(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return 0
+    return max(st.st_size, st.st_blocks * 512)
+
+
+class Reservation:
+    def __init__(self, manager, size, path):
+        self.manager = manager
+        self.size = size
+        self.path = path
+        # artifact cache key of the file, None if it shouldn't be cached
+        self.key = None
+        self.released = False
+
+    @property
+    def disk_size(self):
+        return file_disk_size(self.path)
+
+    @property
+    def accounted_size(self):
+        # file can grow over its estimate while ffmpeg is writing it
+        return max(self.size, self.disk_size)
+
+    def shrink_to_disk_size(self):
+        # give back unused part of estimate when file is completely written
+        self.size = self.disk_size
+        return self.size
+
+    def grow(self, size):
+        # extends reservation of file which is written gradually, False if there is no free space
+        if self.released or not self.manager._make_room(size):
+            return False
+        self.size += size
+        return True
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.manager._release(self)
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class SpoolManager:
+    def __init__(self, directory, capacity):
+        self.directory = directory
+        self.capacity = capacity
+        self.reservations = set()
+        self.cache = None
+
+    @property
+    def reserved(self):
+        return sum(r.size for r in self.reservations)
+
+    @property
+    def used(self):
+        return sum(r.disk_size for r in self.reservations) + (self.cache.size if self.cache else 0)
+
+    @property
+    def free(self):
+        return max(self.capacity - sum(r.accounted_size for r in self.reservations) -
+                   (self.cache.size if self.cache else 0), 0)
+
+    def stats(self):
+        return {'free': self.free, 'reserved': self.reserved, 'used': self.used}
+
+    def _make_room(self, size):
+        if self.free <= size and self.cache is not None:
+            self.cache.evict(size - self.free + 1)
+        return self.free > size
+
+    def reserve(self, size, file_name):
+        if size <= 0:
+            return None
+        if not self._make_room(size):
+            return None
+        if len(file_name) > 100:
+            file_name = file_name[:50] + file_name[-50:]
+        path = os.path.join(self.directory, file_name.replace('/', ''))
+        reservation = Reservation(self, size, path)
+        self.reservations.add(reservation)
+        return reservation
+
+    def _release(self, reservation):
+        self.reservations.discard(reservation)
+
+    def cleanup_orphans(self, directory=None):
+        # directory is spool directory by default, older versions left remux files in working directory
+        directory = directory or self.directory
+        removed = 0
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            if directory == self.directory:
+                os.makedirs(directory, exist_ok=True)
+            return removed
+        active = {r.path for r in self.reservations}
+        for name in names:
+            path = os.path.join(directory, name)
+            if not spool_file_re.search(name) or path in active or not os.path.isfile(path):
+                continue
+            try:
+                os.remove(path)
+                removed += 1
+            except Exception as e:
+                print('failed remove orphaned spool file ' + path + ': ' + str(e))
+        return removed
+
+
+class CacheEntry:
+    def __init__(self, path, size, format):
+        self.path = path
+        self.size = size
+        self.format = format
+        # entry can't be evicted while some upload reads it
+        self.pins = 0
+
+
+class CacheHandle:
+    # looks like Reservation for the code that uploads the file
+    def __init__(self, cache, key, entry):
+        self.cache = cache
+        self.key = key
+        self.entry = entry
+        self.path = entry.path
+        self.format = entry.format
+        self.released = False
+        entry.pins += 1
+
+    def shrink_to_disk_size(self):
+        return self.entry.size
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.entry.pins -= 1
+        self.cache.evict(0)
+
+
+class ArtifactCache:
+    """
+    LRU cache of finished remux files in spool directory.
+    Files are named by digest of their key, so index is restored from disk after restart.
+    """
+
+    def __init__(self, manager, capacity):
+        self.manager = manager
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def digest(key):
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    @property
+    def size(self):
+        return sum(e.size for e in self.entries.values())
+
+    def stats(self):
+        return {'entries': len(self.entries), 'size': self.size,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def load(self):
+        try:
+            names = os.listdir(self.manager.directory)
+        except FileNotFoundError:
+            return 0
+        found = []
+        for name in names:
+            match = cache_file_re.search(name)
+            if match is None:
+                continue
+            path = os.path.join(self.manager.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            found.append((st.st_atime, match.group('digest'), CacheEntry(path, st.st_size, match.group('format'))))
+        for _, digest, entry in sorted(found, key=lambda f: f[0]):
+            self.entries[digest] = entry
+        self.evict(0)
+        return len(self.entries)
+
+    def get(self, key):
+        if key is None or self.capacity == 0:
+            return None
+        digest = self.digest(key)
+        entry = self.entries.get(digest)
+        if entry is None or not os.path.isfile(entry.path):
+            if entry is not None:
+                del self.entries[digest]
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(digest)
+        return CacheHandle(self, key, entry)
+
+    def put(self, reservation, format):
+        # takes ownership of reservation file
+        if isinstance(reservation, CacheHandle):
+            reservation.release()
+            return
+        if reservation.released or reservation.key is None or format is None or \
+                reservation.disk_size > self.capacity:
+            reservation.release()
+            return
+        digest = self.digest(reservation.key)
+        path = os.path.join(self.manager.directory, 'cache-' + digest + '.' + format)
+        try:
+            os.replace(reservation.path, path)
+        except OSError as e:
+            print('failed cache file ' + reservation.path + ': ' + str(e))
+            reservation.release()
+            return
+        old = self.entries.pop(digest, None)
+        if old is not None and old.path != path:
+            self._remove(old)
+        self.entries[digest] = CacheEntry(path, os.path.getsize(path), format)
+        reservation.released = True
+        self.manager._release(reservation)
+        self.evict(0)
+
+    def evict(self, size):
+        # free at least size bytes and fit into capacity, pinned entries are skipped
+        freed = 0
+        for digest in list(self.entries.keys()):
+            if freed >= size and self.size <= self.capacity:
+                break
+            entry = self.entries[digest]
+            if entry.pins > 0:
+                continue
+            del self.entries[digest]
+            self._remove(entry)
+            freed += entry.size
+            self.evictions += 1
+        return freed
+
+    @staticmethod
+    def _remove(entry):
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+manager = SpoolManager(SPOOL_DIR, MAX_STORAGE_SIZE)
+cache = ArtifactCache(manager, min(MAX_CACHE_SIZE, MAX_STORAGE_SIZE))
+manager.cache = cache
+spill_manager = manager if MAX_STORAGE_SIZE > 0 else SpoolManager(SPOOL_DIR, SPILL_STORAGE_SIZE)
@@ -0,0 +1,218 @@
+import abc
+import os
+import json
+import sqlite3
+import threading
+
+
+class StoreError(Exception):
+    pass
+
+
+class UserStore(abc.ABC):
+    """
+    Storage of user and chat settings documents.
+    Documents are dicts with '_id' and '_rev' keys like in CouchDB.
+    Methods are blocking and connect lazily, users module calls them in executor.
+    Stores written by other processes too override last_seq and changes,
+    by default changes returns None which tells SettingsCache that no feed is needed.
+    """
+
+    def connect(self):
+        # called on startup to not wait for connection on first request
+        pass
+
+    @abc.abstractmethod
+    def get(self, id):
+        # returns document or None if it doesn't exist
+        pass
+
+    @abc.abstractmethod
+    def create(self, doc):
+        # returns created document with its revision
+        pass
+
+    @abc.abstractmethod
+    def bulk_write(self, docs):
+        # returns list of {'id', 'rev'} or {'id', 'error', 'reason'} like _bulk_docs
+        pass
+
+    @abc.abstractmethod
+    def get_many(self, ids):
+        # returns dict of id -> document or None
+        pass
+
+    def last_seq(self):
+        # sequence of the latest change, feed started from it gets every change made after the call
+        return None
+
+    def changes(self, since):
+        # blocking iterator of changes made by other processes after since sequence, its items are
+        # _changes rows with 'id', 'seq' and 'doc', or None for heartbeats;
+        # None instead of iterator means there are no other writers and cached documents never go stale
+        return None
+
+
+class CloudantStore(UserStore):
+    def __init__(self, username, password, url, db_name='ytbdownbot'):
+        self.username = username
+        self.password = password
+        self.url = url
+        self.db_name = db_name
+        self._db = None
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        with self._lock:
+            if self._db is None:
+                from cloudant.adapters import Replay429Adapter
+                from cloudant.client import Cloudant
+                client = Cloudant(self.username,
+                                  self.password,
+                                  url=self.url,
+                                  adapter=Replay429Adapter(retries=10),
+                                  connect=True)
+                self._db = client[self.db_name]
+            return self._db
+
+    def connect(self):
+        self.db
+
+    def get(self, id):
+        from requests.exceptions import HTTPError
+        # _changes request is cheaper than document read
+        try:
+            changes = self.db.changes(doc_ids=[id], filter='_doc_ids', include_docs=True)
+            for change in changes:
+                doc = change.get('doc')
+                if doc is None or doc.get('_deleted', False):
+                    return None
+                return dict(doc)
+        except HTTPError as e:
+            raise StoreError(str(e))
+        return None
+
+    def create(self, doc):
+        return dict(self.db.create_document(doc))
+
+    def bulk_write(self, docs):
+        return self.db.bulk_docs(docs)
+
+    def get_many(self, ids):
+        from requests.exceptions import HTTPError
+        docs = {id: None for id in ids}
+        try:
+            rows = self.db.all_docs(keys=list(ids), include_docs=True).get('rows', [])
+        except HTTPError as e:
+            raise StoreError(str(e))
+        for row in rows:
+            # missing documents have no doc field, deleted ones have null
+            if row.get('doc') is not None:
+                docs[row['key']] = row['doc']
+        return docs
+
+    def last_seq(self):
+        from requests.exceptions import HTTPError
+        try:
+            return self.db.metadata()['update_seq']
+        except HTTPError as e:
+            raise StoreError(str(e))
+
+    def changes(self, since):
+        # feed connects lazily, since sequence keeps changes made before that
+        return self.db.infinite_changes(since=since, include_docs=True, heartbeat=30000)
+
+
+class SQLiteStore(UserStore):
+    """
+    Embedded store for small deployments and load testing without network,
+    the process owns the file so there are no external changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, rev INTEGER NOT NULL, body TEXT NOT NULL)')
+            self._conn = conn
+        return self._conn
+
+    def connect(self):
+        with self._lock:
+            self.conn
+
+    @staticmethod
+    def _to_doc(id, rev, body):
+        doc = json.loads(body)
+        doc['_id'] = id
+        doc['_rev'] = str(rev) + '-local'
+        return doc
+
+    @staticmethod
+    def _body(doc):
+        return json.dumps({k: v for k, v in doc.items() if k not in ('_id', '_rev')})
+
+    @staticmethod
+    def _rev_number(doc):
+        try:
+            return int(doc.get('_rev', '0').split('-')[0])
+        except ValueError:
+            return -1
+
+    def get(self, id):
+        with self._lock:
+            row = self.conn.execute('SELECT rev, body FROM docs WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            return None
+        return self._to_doc(id, *row)
+
+    def create(self, doc):
+        with self._lock:
+            try:
+                self.conn.execute('INSERT INTO docs (id, rev, body) VALUES (?, 1, ?)', (doc['_id'], self._body(doc)))
+            except sqlite3.IntegrityError:
+                raise StoreError('document ' + doc['_id'] + ' already exists')
+        return self._to_doc(doc['_id'], 1, self._body(doc))
+
+    def bulk_write(self, docs):
+        results = []
+        with self._lock:
+            conn = self.conn
+            conn.execute('BEGIN')
+            try:
+                for doc in docs:
+                    row = conn.execute('SELECT rev FROM docs WHERE id = ?', (doc['_id'],)).fetchone()
+                    current = row[0] if row is not None else 0
+                    if self._rev_number(doc) != current:
+                        results.append({'id': doc['_id'], 'error': 'conflict', 'reason': 'Document update conflict.'})
+                        continue
+                    conn.execute('INSERT OR REPLACE INTO docs (id, rev, body) VALUES (?, ?, ?)',
+                                 (doc['_id'], current + 1, self._body(doc)))
+                    results.append({'id': doc['_id'], 'rev': str(current + 1) + '-local'})
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+        return results
+
+    def get_many(self, ids):
+        return {id: self.get(id) for id in ids}
+
+
+def new_store():
+    backend = os.getenv('USERS_STORE', 'cloudant')
+    if backend == 'sqlite':
+        return SQLiteStore(os.getenv('USERS_SQLITE_PATH', 'users.sqlite3'))
+    elif backend == 'cloudant':
+        return CloudantStore(os.environ['CLOUDANT_USERNAME'],
+                             os.environ['CLOUDANT_PASSWORD'],
+                             os.environ['CLOUDANT_URL'])
+    raise ValueError('unknown USERS_STORE ' + backend)
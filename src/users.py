@@ -1,10 +1,13 @@
-from cloudant.adapters import Replay429Adapter
-from cloudant.client import Cloudant
-from cloudant.document import Document
-from requests.exceptions import HTTPError
 import os
 import asyncio
+import threading
+import time
+import copy
+from collections import OrderedDict
 from enum import Enum
+import user_store
+import executors
+import joblog
 
 
 class VideoFormat(Enum):
@@ -57,32 +60,28 @@ class User:
         return self.settings['default_media_type']
 
     async def set_default_media_type(self, m_type):
-        self.settings['default_media_type'] = m_type.value
-        await asyncio.get_event_loop().run_in_executor(None, self.settings.save)
+        await self.update(default_media_type=m_type.value)
 
     @property
     def video_format(self):
         return self.settings['video_format']
 
     async def set_video_format(self, vid_format):
-        self.settings['video_format'] = vid_format.value
-        await asyncio.get_event_loop().run_in_executor(None, self.settings.save)
+        await self.update(video_format=vid_format.value)
 
     @property
     def audio_caption(self):
         return self.settings['audio_caption']
 
     async def set_audio_caption(self, toggle):
-        self.settings['audio_caption'] = toggle
-        await asyncio.get_event_loop().run_in_executor(None, self.settings.save)
+        await self.update(audio_caption=toggle)
 
     @property
     def video_caption(self):
         return self.settings['video_caption']
 
     async def set_video_caption(self, toggle):
-        self.settings['video_caption'] = toggle
-        await asyncio.get_event_loop().run_in_executor(None, self.settings.save)
+        await self.update(video_caption=toggle)
 
     @property
     def donator(self):
@@ -93,19 +92,28 @@ class User:
         return self.settings.get('banned', 0) == 1
 
     async def set_donator(self, toggle):
-        self.settings['donator'] = toggle
-        await asyncio.get_event_loop().run_in_executor(None, self.settings.save)
+        await self.update(donator=toggle)
+
+    async def update(self, **fields):
+        # changes are persisted in background by settings_writer
+        self.settings.update(fields)
+        settings_cache.put(self.settings)
+        settings_writer.schedule(self.settings, fields)
 
     async def sync_with_db(self):
-        await asyncio.get_event_loop().run_in_executor(None, self.settings.fetch)
+        settings = await executors.db.run(store.get, self.settings['_id'])
+        if settings is not None:
+            self.settings = settings
+            settings_cache.put(self.settings)
+
+
+# connects on first request
+store = user_store.new_store()
 
 
-client = Cloudant(os.environ['CLOUDANT_USERNAME'],
-                  os.environ['CLOUDANT_PASSWORD'],
-                  url=os.environ['CLOUDANT_URL'],
-                  adapter=Replay429Adapter(retries=10),
-                  connect=True)
-db = client['ytbdownbot']
+async def connect():
+    await executors.db.run(store.connect)
+    settings_cache.start_listener()
 
 
 async def is_user_sane(id):
@@ -119,44 +127,334 @@ async def is_user_sane(id):
 
 
 async def get_user_no_read(id):
-    try:
-        ch_feed = await get_changes(id)
-    except HTTPError:
-        return None
-    try:
-        if '_deleted' in ch_feed['doc'] and ch_feed['doc']['_deleted']:
+    settings_cache.start_listener()
+    cached = settings_cache.get(id)
+    if cached is SettingsCache.MISS:
+        settings_cache.begin_lookup(id)
+        try:
+            cached = settings_cache.end_lookup(id, await lookup_batcher.get(id))
+        except user_store.StoreError:
+            settings_cache.end_lookup(id, None)
+            return None
+        if cached is None:
+            settings_cache.put_missing(id)
             return None
-        doc = Document(db, ch_feed['doc']['_id'])
-        doc.update(ch_feed['doc'])
-        return doc
-    except:
-        return None
+        settings_cache.put(cached)
+    return cached
+
 
 async def get_user(id):
-    return await asyncio.get_event_loop().run_in_executor(None, _get_user, id)
+    return await executors.db.run(_get_user, id)
 
 
 def _get_user(id):
-    user_id = 'user' + str(id)
-    if user_id in db:
-        return db[user_id]
-    else:
-        return None
+    return store.get('user' + str(id))
 
 
 async def create_user(user):
-    return await asyncio.get_event_loop().run_in_executor(None, _create_user, user)
+    doc = await executors.db.run(_create_user, user)
+    settings_cache.put(doc)
+    return doc
 
 
 def _create_user(user):
-    return db.create_document(user)
-
+    return store.create(user)
 
-async def get_changes(doc_id):
-    return await asyncio.get_event_loop().run_in_executor(None, _get_changes, doc_id)
 
-
-def _get_changes(doc_id):
-    changes = db.changes(doc_ids=[doc_id], filter='_doc_ids', include_docs=True)
-    for change in changes:
-        return change
+def rev_generation(doc):
+    try:
+        return int(doc.get('_rev', '0').split('-')[0])
+    except ValueError:
+        return 0
+
+
+class SettingsCache:
+    """
+    LRU cache of settings documents.
+    Cached entries are kept fresh by store changes feed listened in separate thread.
+    The feed starts from the store sequence taken before the cache is used and resumes from the last seen change,
+    the cache is dropped while the feed is down because changes of cached docs come only after it resumes.
+    """
+    MISS = object()
+    NO_CHANGE = object()
+
+    def __init__(self, size):
+        self.size = size
+        self.docs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.loop = None
+        self.listener = None
+        self.listening = False
+        # doc id -> (running lookups, the latest doc from changes feed seen during them)
+        self.lookups = {}
+
+    def stats(self):
+        return {'entries': len(self.docs), 'hits': self.hits, 'misses': self.misses, 'listening': self.listening}
+
+    def get(self, id):
+        # returns copy of doc, None if doc doesn't exist or MISS
+        if not self.listening or id not in self.docs:
+            self.misses += 1
+            return self.MISS
+        self.hits += 1
+        self.docs.move_to_end(id)
+        doc = self.docs[id]
+        return dict(doc) if doc is not None else None
+
+    def _put(self, id, doc):
+        if not self.listening:
+            return
+        old = self.docs.get(id)
+        if old is not None and doc is not None and rev_generation(old) > rev_generation(doc):
+            return
+        self.docs[id] = doc
+        self.docs.move_to_end(id)
+        while len(self.docs) > self.size:
+            self.docs.popitem(last=False)
+
+    def put(self, doc):
+        self._put(doc['_id'], dict(doc))
+
+    def put_missing(self, id):
+        self._put(id, None)
+
+    def begin_lookup(self, id):
+        # changes of documents which are being read are kept until the read finishes,
+        # read result could be older than them
+        count, change = self.lookups.get(id, (0, self.NO_CHANGE))
+        self.lookups[id] = (count + 1, change)
+
+    def end_lookup(self, id, doc):
+        # returns the newer of the read doc and the doc seen in changes feed during the read
+        count, change = self.lookups.pop(id)
+        if count > 1:
+            self.lookups[id] = (count - 1, change)
+        if change is self.NO_CHANGE:
+            return doc
+        if doc is not None and rev_generation(doc) >= rev_generation(change):
+            return doc
+        return None if change.get('_deleted', False) else dict(change)
+
+    def _on_change(self, change):
+        id = change['id']
+        doc = change.get('doc')
+        if id in self.lookups:
+            if doc is None:
+                # deletion without doc, its revision is in changes list
+                rev = (change.get('changes') or [{}])[0].get('rev', '0')
+                doc = {'_id': id, '_rev': rev, '_deleted': True}
+            count, seen = self.lookups[id]
+            if seen is self.NO_CHANGE or rev_generation(seen) <= rev_generation(doc):
+                self.lookups[id] = (count, doc)
+        # only cached documents are updated, others are read on demand
+        if id not in self.docs:
+            return
+        if doc is None or doc.get('_deleted', False):
+            self.docs[id] = None
+        else:
+            self._put(id, doc)
+
+    def _on_feed_state(self, listening):
+        self.listening = listening
+        if not listening:
+            self.docs.clear()
+
+    def start_listener(self):
+        if self.listener is not None or self.size <= 0:
+            return
+        self.loop = asyncio.get_event_loop()
+        self.listener = threading.Thread(target=self._listen, name='settings-changes', daemon=True)
+        self.listener.start()
+
+    def _listen(self):
+        seq = None
+        while True:
+            try:
+                if seq is None:
+                    seq = store.last_seq()
+                feed = store.changes(seq)
+                # changes after seq are delivered even if the feed connects later
+                self.loop.call_soon_threadsafe(self._on_feed_state, True)
+                if feed is None:
+                    # nobody else writes to the store
+                    return
+                for change in feed:
+                    if change and 'id' in change:
+                        seq = change.get('seq', seq)
+                        self.loop.call_soon_threadsafe(self._on_change, change)
+            except Exception as e:
+                joblog.log.warning('settings changes feed failed: ' + str(e))
+            self.loop.call_soon_threadsafe(self._on_feed_state, False)
+            time.sleep(5)
+
+
+settings_cache = SettingsCache(int(os.getenv('USERS_CACHE_SIZE', 10000)))
+
+
+class SettingsWriter:
+    """
+    Write-behind queue of settings changes.
+    Changes of the same document are coalesced during the flush delay and written with single _bulk_docs request,
+    on conflict changed fields are merged into the latest revision instead of retrying whole update.
+    Documents which aren't written are queued again under newer changes and retried with backoff.
+    """
+
+    def __init__(self, delay, retries=5, max_backoff=60):
+        self.delay = delay
+        self.retries = retries
+        self.max_backoff = max_backoff
+        # failed flushes in a row
+        self.failures = 0
+        # doc id -> (document, changed fields)
+        self.pending = {}
+        self.flush_task = None
+        self.changes = 0
+        self.writes = 0
+        self.docs_written = 0
+        self.conflicts = 0
+        self.requeued = 0
+
+    def stats(self):
+        return {'changes': self.changes, 'writes': self.writes, 'docs_written': self.docs_written,
+                'conflicts': self.conflicts, 'requeued': self.requeued, 'pending': len(self.pending)}
+
+    def schedule(self, doc, fields):
+        self.changes += 1
+        _, pending_fields = self.pending.get(doc['_id'], (None, {}))
+        pending_fields.update(fields)
+        # several User copies of one document can change different fields,
+        # the latest copy is written with all of them
+        doc.update(pending_fields)
+        self.pending[doc['_id']] = (doc, pending_fields)
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.get_event_loop().create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.delay)
+        await self.flush()
+
+    async def flush(self):
+        while len(self.pending) != 0:
+            batch = self.pending
+            self.pending = {}
+            written = set()
+            try:
+                await executors.db.run(self._write, batch, written)
+            except Exception as e:
+                joblog.log.warning('failed write settings: ' + str(e))
+            for id, (doc, fields) in batch.items():
+                if id in written:
+                    settings_cache.put(doc)
+                else:
+                    self._requeue(doc, fields)
+            if len(written) == len(batch):
+                self.failures = 0
+                continue
+            self.failures += 1
+            await asyncio.sleep(min(self.delay * 2 ** self.failures, self.max_backoff))
+
+    def _requeue(self, doc, fields):
+        # changes made during the write are newer than ours
+        self.requeued += 1
+        newer_doc, newer_fields = self.pending.get(doc['_id'], (doc, {}))
+        merged = dict(fields)
+        merged.update(newer_fields)
+        newer_doc.update(merged)
+        if newer_doc is not doc and rev_generation(doc) > rev_generation(newer_doc):
+            # merged with the latest revision on conflict
+            newer_doc['_rev'] = doc['_rev']
+        self.pending[doc['_id']] = (newer_doc, merged)
+
+    def _write(self, batch, written):
+        # documents are the same objects User holds, so they get the new revision too,
+        # ids of documents with confirmed revision are added to written
+        docs = {id: doc for id, (doc, _) in batch.items()}
+        for _ in range(self.retries):
+            self.writes += 1
+            results = store.bulk_write([_plain_doc(doc) for doc in docs.values()])
+            conflicted = []
+            for res in results:
+                doc = docs.get(res.get('id'))
+                if doc is None:
+                    continue
+                if 'rev' in res and 'error' not in res:
+                    doc['_rev'] = res['rev']
+                    written.add(res['id'])
+                    self.docs_written += 1
+                elif res.get('error') == 'conflict':
+                    conflicted.append(res['id'])
+                else:
+                    joblog.log.warning('failed write settings of ' + res['id'] + ': ' + str(res.get('reason')))
+            if len(conflicted) == 0:
+                return
+            self.conflicts += len(conflicted)
+            latest = store.get_many(conflicted)
+            docs = {}
+            for id, latest_doc in latest.items():
+                doc, fields = batch[id]
+                if latest_doc is not None:
+                    # field level merge, the latest revision with our changes on top
+                    for key, value in latest_doc.items():
+                        if key not in fields:
+                            doc[key] = value
+                    doc['_rev'] = latest_doc['_rev']
+                else:
+                    # document was deleted, write it from scratch
+                    doc.pop('_rev', None)
+                docs[id] = doc
+        joblog.log.warning('gave up writing settings of ' + ', '.join(docs.keys()) + ' for now')
+
+
+def _plain_doc(doc):
+    return copy.deepcopy(dict(doc))
+
+
+class LookupBatcher:
+    """
+    Collects documents requested during short delay and reads them with single store request,
+    concurrent lookups of the same document share the result.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        # doc id -> future
+        self.pending = {}
+        self.flush_task = None
+        self.lookups = 0
+        self.requests = 0
+
+    def stats(self):
+        return {'lookups': self.lookups, 'requests': self.requests}
+
+    def get(self, id):
+        self.lookups += 1
+        future = self.pending.get(id)
+        if future is None:
+            future = asyncio.get_event_loop().create_future()
+            self.pending[id] = future
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.get_event_loop().create_task(self._flush())
+        return asyncio.shield(future)
+
+    async def _flush(self):
+        # lookups made while a batch is read go to the next batch
+        while len(self.pending) != 0:
+            await asyncio.sleep(self.delay)
+            batch = self.pending
+            self.pending = {}
+            self.requests += 1
+            try:
+                docs = await executors.db.run(store.get_many, list(batch.keys()))
+            except Exception as e:
+                for future in batch.values():
+                    if not future.done():
+                        future.set_exception(e if isinstance(e, user_store.StoreError) else user_store.StoreError(str(e)))
+                continue
+            for id, future in batch.items():
+                if not future.done():
+                    future.set_result(docs.get(id))
+
+
+lookup_batcher = LookupBatcher(int(os.getenv('USERS_LOOKUP_DELAY', 2)) / 1000)
+settings_writer = SettingsWriter(int(os.getenv('SETTINGS_FLUSH_DELAY', 500)) / 1000)
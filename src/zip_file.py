@@ -1,11 +1,22 @@
-
 import typing
-import zipstream
+import asyncio
+import struct
+import zlib
 import math as m
 import time
+import executors
 
 
 TG_MAX_FILE_SIZE = 2000*1024*1024
+# crc32 is calculated in thread pool by chunks of this size, zlib releases GIL for it
+CRC_CHUNK_SIZE = 8 * 1024 * 1024
+
+ZIP_VERSION = 45  # zip64
+ZIP_FLAGS = 0x08 | 0x800  # data descriptor, utf-8 names
+ZIP_LOCAL_HEADER_SIZE = 30 + 20  # + zip64 extra field
+ZIP_DATA_DESCRIPTOR_SIZE = 24
+ZIP_CENTRAL_HEADER_SIZE = 46 + 28  # + zip64 extra field
+ZIP_END_SIZE = 56 + 20 + 22  # zip64 end record, zip64 locator, end record
 
 
 class Reader(typing.BinaryIO):
@@ -70,59 +81,176 @@ class Reader(typing.BinaryIO):
         pass
 
 
+def dos_time(t=None):
+    lt = time.localtime(t)
+    return ((lt.tm_hour << 11) | (lt.tm_min << 5) | (lt.tm_sec // 2),
+            ((lt.tm_year - 1980) << 9) | (lt.tm_mon << 5) | lt.tm_mday)
+
+
+class ZipStream:
+    """
+    Streaming stored (not compressed) ZIP64 archive writer.
+    Layout doesn't depend on content, so archive size is known exactly from file sizes.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def write_iter(self, name, file_iter, size=None):
+        self.entries.append((name.encode('utf-8'), file_iter, size))
+
+    def write_lazy(self, opener):
+        # opener is coroutine function returning (name, file_iter, size) when entry is about to be written,
+        # or None to skip the entry
+        self.entries.append((None, opener, None))
+
+    @staticmethod
+    def entry_size(name, size):
+        n = len(name.encode('utf-8')) if isinstance(name, str) else len(name)
+        return ZIP_LOCAL_HEADER_SIZE + n + size + ZIP_DATA_DESCRIPTOR_SIZE + ZIP_CENTRAL_HEADER_SIZE + n
+
+    @property
+    def size(self):
+        if any(name is None or size is None for name, _, size in self.entries):
+            return None
+        return sum(self.entry_size(name, size) for name, _, size in self.entries) + ZIP_END_SIZE
+
+    def __aiter__(self):
+        return self._generate()
+
+    async def _generate(self):
+        mtime, mdate = dos_time()
+        offset = 0
+        central = []
+        for name, file_iter, declared_size in self.entries:
+            if name is None:
+                opened = await file_iter()
+                if opened is None:
+                    continue
+                name, file_iter, declared_size = opened
+                name = name.encode('utf-8')
+            header = struct.pack('<IHHHHHIIIHH', 0x04034b50, ZIP_VERSION, ZIP_FLAGS, 0, mtime, mdate,
+                                 0, 0xFFFFFFFF, 0xFFFFFFFF, len(name), 20) + name + \
+                struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+            yield header
+            crc = 0
+            crc_future = None
+            pending = bytearray()
+            size = 0
+            async for data in file_iter:
+                if not data:
+                    continue
+                size += len(data)
+                pending.extend(data)
+                if len(pending) >= CRC_CHUNK_SIZE:
+                    if crc_future is not None:
+                        crc = await crc_future
+                    crc_future = asyncio.ensure_future(executors.file_io.run(zlib.crc32, bytes(pending), crc))
+                    pending.clear()
+                yield data
+            if crc_future is not None:
+                crc = await crc_future
+            crc = zlib.crc32(pending, crc)
+            if declared_size is not None and declared_size != size:
+                raise Exception('Archived file size {} differs from expected {}'.format(size, declared_size))
+            yield struct.pack('<IIQQ', 0x08074b50, crc, size, size)
+            central.append((name, crc, size, offset))
+            offset += len(header) + size + ZIP_DATA_DESCRIPTOR_SIZE
+
+        cd_size = 0
+        for name, crc, size, entry_offset in central:
+            record = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, ZIP_VERSION, ZIP_VERSION, ZIP_FLAGS, 0,
+                                 mtime, mdate, crc, 0xFFFFFFFF, 0xFFFFFFFF, len(name), 28, 0, 0, 0, 0,
+                                 0xFFFFFFFF) + name + \
+                struct.pack('<HHQQQ', 0x0001, 24, size, size, entry_offset)
+            cd_size += len(record)
+            yield record
+
+        cd_offset = offset
+        zip64_end_offset = cd_offset + cd_size
+        yield struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, ZIP_VERSION, ZIP_VERSION, 0, 0,
+                          len(central), len(central), cd_size, cd_offset) + \
+            struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1) + \
+            struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0)
+
+
+async def raw_stream(file_iter, declared_size=None):
+    size = 0
+    async for data in file_iter:
+        size += len(data)
+        yield data
+    if declared_size is not None and declared_size != size:
+        raise Exception('File size {} differs from expected {}'.format(size, declared_size))
+
+
+def safe_name(name):
+    last_repl = False
+    f_name = ''
+    for i in name:
+        if not i.isalnum():
+            f_name += '_' if last_repl == False else ''
+            last_repl = True
+        else:
+            f_name += i
+            last_repl = False
+    return f_name
+
+
 class ZipTorrentContentFile(Reader):
-    def __init__(self, file_iter, name, size):
+    """
+    Splits zip archive (or raw file if raw=True) with one file into parts of TG_MAX_FILE_SIZE.
+    size is exact file size or 0 if it's unknown, then parts size is unknown as well.
+    Archive of many files is made by passing openers list for ZipStream.write_lazy instead of file_iter.
+    """
+
+    def __init__(self, file_iter, name, size, raw=False, openers=None):
         self.buf = bytes()
         self.processed_size = 0
-        # self.progress_text = None
-        self.files_size_sum = 0
-        file_names_sum = 0
-        self.zipstream = zipstream.ZipFile(mode='w', compression=zipstream.ZIP_STORED, allowZip64=True)
-        self.zipstream.write_iter(name, file_iter)
-        self.files_size_sum += size if size != 0 else 100 * 1024 * 1024 * 1024
-        file_names_sum += len(name.encode('utf'))
-
-        #self.real_size = 21438417 + 205 + 6 #len(files) * (30 + 16 + 46) + 2 * file_names_sum + files_size_sum + 22 + 512
-        self.real_size = (30 + 16 + 46) + 2 * file_names_sum + self.files_size_sum + 22 + 5120
-
-        self.big = self.real_size > TG_MAX_FILE_SIZE
-        self._size = TG_MAX_FILE_SIZE if self.big else self.real_size
-
-        last_repl = False
-        f_name = ''
-        for i in name:
-            if not i.isalnum():
-                f_name += '_' if last_repl == False else ''
-                last_repl = True
+        self.raw = raw
+        if raw:
+            self.zipstream = raw_stream(file_iter, size if size != 0 else None)
+            self.real_size = size if size != 0 else None
+            stem, dot, ext = name.rpartition('.')
+            self._name = safe_name(stem) + dot + safe_name(ext) if dot else safe_name(name)
+        else:
+            self.zipstream = ZipStream()
+            if openers is not None:
+                for opener in openers:
+                    self.zipstream.write_lazy(opener)
             else:
-                f_name += i
-                last_repl = False
+                self.zipstream.write_iter(name, file_iter, size if size != 0 else None)
+            self.real_size = self.zipstream.size
+            self._name = safe_name(name)
+
+        self.big = self.real_size is None or self.real_size > TG_MAX_FILE_SIZE
+        self._size = TG_MAX_FILE_SIZE if self.big else self.real_size
 
-        self._name = f_name
         self.zip_num = 1
         self.must_next_file = False
-        self.zip_parts = m.ceil(self.real_size / TG_MAX_FILE_SIZE)
-        self.downloaded_bytes_count = 0
-        self.last_percent = -1
-        self.should_close = False
+        self.zip_parts = m.ceil(self.real_size / TG_MAX_FILE_SIZE) if self.real_size is not None else None
         self.zipiter = self.zipstream.__aiter__()
         self.is_finished = False
-        self.last_progress_update = time.time()
 
 
     @property
     def size(self):
+        return self.part_size(self.zip_num)
+
+    def part_size(self, num):
+        # None if size is unknown
+        if self.real_size is None:
+            return None
         if self.big:
-            data_left = self.real_size - (self.zip_num - 1) * TG_MAX_FILE_SIZE
+            data_left = self.real_size - (num - 1) * TG_MAX_FILE_SIZE
             if data_left > TG_MAX_FILE_SIZE:
                 return TG_MAX_FILE_SIZE
             else:
-                return data_left
+                return max(data_left, 0)
         else:
             return self._size
 
     def close(self):
-        self.zipstream.close()
+        pass
 
     def closed(self):
         return False
@@ -179,60 +307,91 @@ class ZipTorrentContentFile(Reader):
 
     @property
     def name(self):
-        if self.big:
-            return self._name[:20]+'.zip'+'.{:03d}'.format(self.zip_num)
+        return self.part_name(self.zip_num)
+
+    def part_name(self, num, last=False):
+        # archive of unknown size is numbered unless its first part appears to be the last one
+        split = self.big and not (last and num == 1)
+        if self.raw:
+            return self._name + ('.{:03d}'.format(num) if split else '')
+        if split:
+            return self._name[:20]+'.zip'+'.{:03d}'.format(num)
         else:
             return self._name + '.zip'
 
     async def read(self, n=-1):
-        resp = bytes()
-        if len(self.buf) != 0:
-            resp = self.buf
-            self.buf = bytes()
+        # reads no more than left to the end of current part
         if n == -1:
-            n = self.size
-        if n + self.processed_size > TG_MAX_FILE_SIZE:
-            n = TG_MAX_FILE_SIZE - self.processed_size
-        elif n + self.processed_size > self.size:
-            n = self.size - self.processed_size
-
-        async for data in self.zipiter:
-            if data is None:
+            n = TG_MAX_FILE_SIZE
+        n = min(n, TG_MAX_FILE_SIZE - self.processed_size)
+        resp = bytearray(self.buf)
+        while len(resp) < n and not self.is_finished:
+            try:
+                data = await self.zipiter.__anext__()
+            except StopAsyncIteration:
+                self.is_finished = True
                 break
-            resp += data
-            if not (len(resp) < n and self.processed_size < TG_MAX_FILE_SIZE):
-                break
-
-                #if time.time() - self.last_progress_update > 2:
-                #    await self.event.edit(self.progress_text.format(str(m.floor((self.downloaded_bytes_count*100) / self.size))))
-                #    self.last_progress_update = time.time()
-                #resp += await self.zipstream.__aiter__().__next__()
-                #if len(resp) == 0 and self.should_close == False:
-                #    print("\nSHOULD CLOSE CALL\n")
-                #    self.zipiter = iter(self.zipstream)
-                #    self.should_close = True
-                #    continue
-        if len(resp) > n:
-            self.buf = resp[n:]
-            resp = resp[0:n]
-
-        if len(resp) != 0 and n == 0:
-            # send last piece
-            self.processed_size += len(resp)
-            return resp
+            resp.extend(data)
+        self.buf = bytes(resp[n:])
+        del resp[n:]
 
         self.processed_size += len(resp)
-
         if self.processed_size >= TG_MAX_FILE_SIZE:
-            #if self.is_finished == False and self.real_size - TG_MAX_FILE_SIZE <= 0:
-            #    self.real_size += 1024
-            #    TG_MAX_FILE_SIZE = TG_MAX_FILE_SIZE if self.should_split else self.real_size
-            #    self.big = self.real_size > TG_MAX_FILE_SIZE
-            #    self.size = TG_MAX_FILE_SIZE if self.big else self.real_size
-            #else:
             self.processed_size = 0
             self.must_next_file = True
-            #self.real_size -= TG_MAX_FILE_SIZE
-            # self._size = TG_MAX_FILE_SIZE if self.real_size > TG_MAX_FILE_SIZE else self.real_size
 
-        return resp
+        return bytes(resp)
+
+
+class ZipPart(Reader):
+    """
+    Reads one part of ZipTorrentContentFile, so parts can be buffered
+    and uploaded independently. Part starts reading only when previous one is finished.
+    """
+
+    def __init__(self, zfile, num, previous=None):
+        self.zfile = zfile
+        self.num = num
+        self.previous = previous
+        self.size = zfile.part_size(num)
+        self.read_bytes = 0
+        # set when zip stream ended in this part
+        self.last = False
+        self.finished = asyncio.Event()
+        # set when part got first data or appeared to be empty
+        self.ready = asyncio.Event()
+
+    @property
+    def name(self):
+        return self.zfile.part_name(self.num, self.last)
+
+    @property
+    def empty(self):
+        return self.finished.is_set() and self.read_bytes == 0
+
+    def _finish(self):
+        self.last = self.zfile.is_finished and len(self.zfile.buf) == 0
+        self.finished.set()
+        self.ready.set()
+
+    async def read(self, n=-1):
+        if self.previous is not None:
+            await self.previous.finished.wait()
+        if self.finished.is_set():
+            return b''
+        if self.zfile.must_next_file:
+            # previous read reached part size limit
+            self.zfile.must_next_file = False
+            self._finish()
+            return b''
+        self.zfile.zip_num = self.num
+        data = await self.zfile.read(n)
+        if len(data) == 0:
+            self._finish()
+            return b''
+        self.read_bytes += len(data)
+        self.ready.set()
+        return data
+
+    def close(self):
+        pass
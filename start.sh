@@ -2,7 +2,9 @@
 
 export PATH=${PATH}:/usr/local/bin:/usr/sbin
 
-pip3 install youtube-dl
+# youtube-dl is updated by cron, install it only on first boot
+pip3 show youtube-dl > /dev/null 2>&1 || pip3 install youtube-dl
+python3 make_lazy_extractors.py
 crond
 # to wait until old connection will be reseted 
 exec python3 main.py
@@ -0,0 +1,22 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pytest
+
+pytest.importorskip('telethon')
+
+import fast_telethon
+
+
+class EmptyStream:
+    async def read(self, n=-1):
+        return b''
+
+
+def test_empty_stream_is_rejected_before_upload():
+    # client isn't touched, the stream is checked before any upload request
+    with pytest.raises(ValueError, match='empty'):
+        asyncio.run(fast_telethon.upload_file(None, EmptyStream(), None, 'empty.mp4'))
@@ -0,0 +1,15 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import metrics
+
+
+def test_stats_counters_have_total_suffix():
+    stats = metrics.Stats('cache', lambda: {'hits': 3, 'entries': 2}, counters=('hits',))
+    lines = stats.render().split('\n')
+    assert '# TYPE ytbdownbot_cache_hits_total counter' in lines
+    assert 'ytbdownbot_cache_hits_total 3' in lines
+    assert '# TYPE ytbdownbot_cache_entries gauge' in lines
+    assert 'ytbdownbot_cache_entries 2' in lines
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('ffmpeg')
+
+import spill_buffer
+import spool
+
+MB = 1024 * 1024
+
+
+class NumberedSource:
+    # chunk i is filled with byte i % 256 so order of the data can be checked
+    def __init__(self, size):
+        self.left = size
+        self.chunk = 0
+
+    async def read(self, n):
+        n = min(n, self.left)
+        self.left -= n
+        data = bytes([self.chunk % 256]) * n
+        self.chunk += 1
+        return data
+
+    def close(self):
+        pass
+
+
+async def _read_all(buffer):
+    chunks = []
+    while True:
+        data = await buffer.read(spill_buffer.READ_CHUNK_SIZE)
+        if not data:
+            return chunks
+        chunks.append(data)
+        # slow consumer makes the producer run ahead
+        await asyncio.sleep(0.001)
+
+
+def _check_order(chunks):
+    for i, data in enumerate(chunks):
+        assert data == bytes([i % 256]) * len(data)
+
+
+def test_default_budget_spills_without_storage_size():
+    assert spool.spill_manager.capacity > 0
+
+
+def test_spills_past_memory_size(tmp_path):
+    manager = spool.SpoolManager(str(tmp_path), 64 * MB)
+
+    async def run():
+        buffer = spill_buffer.SpillBuffer(NumberedSource(8 * MB), memory_size=MB,
+                                          spool_dir=str(tmp_path), manager=manager)
+        await asyncio.sleep(0.1)
+        chunks = await _read_all(buffer)
+        stats = buffer.stats()
+        await buffer.close()
+        return chunks, stats
+
+    chunks, stats = asyncio.run(run())
+    assert sum(len(c) for c in chunks) == 8 * MB
+    _check_order(chunks)
+    assert stats['spilled_bytes'] > 0
+    assert manager.reserved == 0
+
+
+def test_waits_for_consumer_when_spool_is_full(tmp_path):
+    manager = spool.SpoolManager(str(tmp_path), 0)
+
+    async def run():
+        buffer = spill_buffer.SpillBuffer(NumberedSource(4 * MB), memory_size=MB,
+                                          spool_dir=str(tmp_path), manager=manager)
+        chunks = await _read_all(buffer)
+        stats = buffer.stats()
+        await buffer.close()
+        return chunks, stats
+
+    chunks, stats = asyncio.run(run())
+    assert sum(len(c) for c in chunks) == 4 * MB
+    _check_order(chunks)
+    assert stats['spilled_bytes'] == 0
+    assert stats['spill_waits'] > 0
@@ -0,0 +1,160 @@
+import asyncio
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ['USERS_STORE'] = 'sqlite'
+
+import pytest
+
+import user_store
+import users
+
+
+def _use_store(tmp_path, monkeypatch, cache_size):
+    store = user_store.SQLiteStore(str(tmp_path / 'users.sqlite3'))
+    monkeypatch.setattr(users, 'store', store)
+    monkeypatch.setattr(users, 'settings_cache', users.SettingsCache(cache_size))
+    monkeypatch.setattr(users, 'settings_writer', users.SettingsWriter(0.01))
+    monkeypatch.setattr(users, 'lookup_batcher', users.LookupBatcher(0.001))
+    return store
+
+
+@pytest.mark.parametrize('cache_size', [0, 100])
+def test_copies_of_document_change_different_fields(tmp_path, monkeypatch, cache_size):
+    store = _use_store(tmp_path, monkeypatch, cache_size)
+
+    async def run():
+        await users.User.init(1)
+        # separate lookups give separate copies of the document
+        a = await users.User.init(1)
+        b = await users.User.init(1)
+        assert a.settings is not b.settings
+        await a.set_video_format(users.VideoFormat.HIGH)
+        await b.set_audio_caption(True)
+        await users.settings_writer.flush()
+
+    asyncio.run(run())
+    doc = store.get('user1')
+    assert doc['video_format'] == users.VideoFormat.HIGH.value
+    assert doc['audio_caption'] is True
+
+
+class StopListening(BaseException):
+    pass
+
+
+class FeedStore:
+    # changes feed which fails after every change
+    def __init__(self):
+        self.since = []
+
+    def last_seq(self):
+        return '5-a'
+
+    def changes(self, since):
+        self.since.append(since)
+        if len(self.since) > 2:
+            raise StopListening()
+        return iter([{'id': 'user1', 'seq': str(6 + len(self.since)) + '-a', 'doc': {'_id': 'user1', '_rev': '2-a'}},
+                     None])
+
+
+class DirectLoop:
+    def call_soon_threadsafe(self, callback, *args):
+        callback(*args)
+
+
+def test_changes_feed_starts_from_store_sequence_and_resumes(monkeypatch):
+    store = FeedStore()
+    monkeypatch.setattr(users, 'store', store)
+    monkeypatch.setattr(users.time, 'sleep', lambda s: None)
+    cache = users.SettingsCache(100)
+    cache.loop = DirectLoop()
+    with pytest.raises(StopListening):
+        cache._listen()
+    assert store.since == ['5-a', '7-a', '8-a']
+
+
+class FlakyStore(user_store.SQLiteStore):
+    # first bulk write fails and the second one is a conflict
+    def __init__(self, path):
+        super().__init__(path)
+        self.bulk_writes = 0
+
+    def bulk_write(self, docs):
+        self.bulk_writes += 1
+        if self.bulk_writes == 1:
+            raise user_store.StoreError('store is down')
+        if self.bulk_writes == 2:
+            return [{'id': doc['_id'], 'error': 'conflict', 'reason': 'Document update conflict.'} for doc in docs]
+        return super().bulk_write(docs)
+
+
+def test_failed_writes_are_retried_under_newer_changes(tmp_path, monkeypatch):
+    store = FlakyStore(str(tmp_path / 'users.sqlite3'))
+    monkeypatch.setattr(users, 'store', store)
+    monkeypatch.setattr(users, 'settings_cache', users.SettingsCache(100))
+    monkeypatch.setattr(users, 'settings_writer', users.SettingsWriter(0.01, retries=1))
+    monkeypatch.setattr(users, 'lookup_batcher', users.LookupBatcher(0.001))
+    store.create({'_id': 'user1'})
+
+    async def run():
+        a = await users.User.init(1)
+        await a.set_video_format(users.VideoFormat.HIGH)
+        flush = asyncio.ensure_future(users.settings_writer.flush())
+        await asyncio.sleep(0)
+        # changed while the first write fails
+        await a.set_audio_caption(True)
+        await flush
+
+    asyncio.run(run())
+    doc = store.get('user1')
+    assert doc['video_format'] == users.VideoFormat.HIGH.value
+    assert doc['audio_caption'] is True
+    assert store.bulk_writes == 3
+    assert len(users.settings_writer.pending) == 0
+
+
+def test_store_without_required_methods_is_rejected():
+    class PartialStore(user_store.UserStore):
+        def get(self, id):
+            return None
+
+    with pytest.raises(TypeError):
+        PartialStore()
+    assert user_store.SQLiteStore(':memory:').changes(None) is None
+
+
+class BlockingStore(user_store.SQLiteStore):
+    # get_many waits until it's released
+    def __init__(self, path):
+        super().__init__(path)
+        self.reading = threading.Event()
+        self.release = threading.Event()
+
+    def get_many(self, ids):
+        self.reading.set()
+        self.release.wait(5)
+        return super().get_many(ids)
+
+
+def test_lookup_made_during_batch_read_is_flushed(tmp_path, monkeypatch):
+    store = BlockingStore(str(tmp_path / 'users.sqlite3'))
+    monkeypatch.setattr(users, 'store', store)
+    batcher = users.LookupBatcher(0.001)
+    store.create({'_id': 'user1'})
+    store.create({'_id': 'user2'})
+
+    async def run():
+        first = asyncio.ensure_future(batcher.get('user1'))
+        await asyncio.get_event_loop().run_in_executor(None, store.reading.wait, 5)
+        second = asyncio.ensure_future(batcher.get('user2'))
+        store.release.set()
+        return await asyncio.wait_for(asyncio.gather(first, second), 5)
+
+    first, second = asyncio.run(run())
+    assert first['_id'] == 'user1'
+    assert second['_id'] == 'user2'
+    assert batcher.requests == 2
@@ -0,0 +1,46 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import zip_file
+
+
+class ChunkSource:
+    def __init__(self, size):
+        self.left = size
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.left == 0:
+            raise StopAsyncIteration
+        n = min(64 * 1024, self.left)
+        self.left -= n
+        return b'x' * n
+
+
+async def read_parts(zfile):
+    names = []
+    part = zip_file.ZipPart(zfile, 1)
+    while True:
+        while len(await part.read(512 * 1024)) != 0:
+            pass
+        if part.empty:
+            break
+        names.append(part.name)
+        part = zip_file.ZipPart(zfile, part.num + 1, previous=part)
+    return names
+
+
+def test_single_part_of_unknown_size_is_not_numbered():
+    zfile = zip_file.ZipTorrentContentFile(ChunkSource(1024 * 1024), 'video.mp4', 0)
+    assert asyncio.run(read_parts(zfile)) == ['video_mp4.zip']
+
+
+def test_parts_of_unknown_size_are_numbered(monkeypatch):
+    monkeypatch.setattr(zip_file, 'TG_MAX_FILE_SIZE', 400 * 1024)
+    zfile = zip_file.ZipTorrentContentFile(ChunkSource(1024 * 1024), 'video.mp4', 0)
+    assert asyncio.run(read_parts(zfile)) == ['video_mp4.zip.001', 'video_mp4.zip.002', 'video_mp4.zip.003']